@@ -34,4 +34,5 @@ Includes support for:
 		'tp.client.pyscheme',
 	],
 	zip_safe=False,
+	python_requires=">=2.5",
 )
@@ -1,15 +1,198 @@
+import threading
+from array import array
 from types import TupleType
 
+class Missing(object):
+	"""\
+	The "value" of a key which isn't in a dictionary.
+	"""
+	def __repr__(self):
+		return "<missing>"
+missing = Missing()
+
+# Marks an empty slot in ModTimes
+empty = float('nan')
+# Older than any time
+never = float('-inf')
+
+class ModTimes(object):
+	"""\
+	The modify times of a ChangeDict.
+
+	Behaves like a dictionary but the times for non-negative integer keys
+	(which is what the server uses for IDs) are kept in an array of doubles
+	indexed by the key. This takes 8 bytes a key rather than a dictionary
+	entry and a float object. Other keys, and IDs which are far bigger than
+	the number of times stored, go in a normal dictionary.
+
+	Every access is a Python method call, so this is slower than a dictionary
+	(see the benchmark at the bottom). It is only worth it for universes so
+	big that the memory matters, ChangeDicts use a dictionary unless given
+	this as their timesclass.
+	"""
+	__slots__ = ('dense', 'sparse', 'count')
+
+	# The array only grows to fit a key if it would be at least this full
+	fill = 0.25
+
+	def __init__(self):
+		self.dense  = array('d')
+		self.sparse = {}
+		self.count  = 0
+
+	def __getitem__(self, key):
+		if key.__class__ is int and 0 <= key < len(self.dense):
+			time = self.dense[key]
+			if time == time:
+				return time
+		return self.sparse[key]
+
+	def __setitem__(self, key, time):
+		dense = self.dense
+		if key.__class__ is int and key >= 0:
+			if key < len(dense):
+				old = dense[key]
+				dense[key] = time
+				if old != old:
+					self.count += 1
+				return
+
+			size = max(key+1, len(dense)*2)
+			if len(self)+1 >= size*self.fill:
+				self.grow(size)
+				self[key] = time
+				return
+
+		self.sparse[key] = time
+
+	def grow(self, size):
+		"""\
+		Makes the array big enough for keys up to size, moving the keys which
+		now fit out of the dictionary.
+		"""
+		# Make room for the bigger keys in the dictionary too, if they would
+		# fill the extra space as well
+		ints = [key for key in self.sparse if key.__class__ is int and key >= size]
+		if len(ints) > 0 and len(ints) >= (max(ints)+1-size)*self.fill:
+			size = max(ints)+1
+
+		dense = self.dense
+		dense.extend(array('d', [empty])*(size-len(dense)))
+
+		sparse = {}
+		for key, time in self.sparse.iteritems():
+			if key.__class__ is int and 0 <= key < size:
+				dense[key] = time
+				self.count += 1
+			else:
+				sparse[key] = time
+		# (A new dictionary, as they never shrink)
+		self.sparse = sparse
+
+	def __delitem__(self, key):
+		if key.__class__ is int and 0 <= key < len(self.dense):
+			if self.dense[key] == self.dense[key]:
+				self.dense[key] = empty
+				self.count -= 1
+				return
+		del self.sparse[key]
+
+	def get(self, key, default=None):
+		if key.__class__ is int and 0 <= key < len(self.dense):
+			time = self.dense[key]
+			if time == time:
+				return time
+		return self.sparse.get(key, default)
+
+	def has_key(self, key):
+		if key.__class__ is int and 0 <= key < len(self.dense):
+			if self.dense[key] == self.dense[key]:
+				return True
+		return key in self.sparse
+
+	def older(self, pairs):
+		"""\
+		Returns the keys from (key, time) pairs which are missing or have an
+		older time.
+		"""
+		dense  = self.dense
+		size   = len(dense)
+		sparse = self.sparse.get
+
+		result = []
+		for key, time in pairs:
+			if key.__class__ is int and 0 <= key < size:
+				current = dense[key]
+				if current == current:
+					if current < time:
+						result.append(key)
+					continue
+			if sparse(key, never) < time:
+				result.append(key)
+		return result
+	__contains__ = has_key
+
+	def __len__(self):
+		return self.count + len(self.sparse)
+
+	def __iter__(self):
+		for key, time in enumerate(self.dense):
+			if time == time:
+				yield key
+		for key in self.sparse.keys():
+			yield key
+	iterkeys = __iter__
+
+	def keys(self):
+		return list(self)
+
+	def iteritems(self):
+		for key, time in enumerate(self.dense):
+			if time == time:
+				yield key, time
+		for item in self.sparse.items():
+			yield item
+
+	def items(self):
+		return list(self.iteritems())
+
+	def clear(self):
+		self.dense  = array('d')
+		self.sparse = {}
+		self.count  = 0
+
+	def copy(self):
+		return dict(self.iteritems())
+
+	def __repr__(self):
+		return repr(self.copy())
+
 class ChangeDict(dict):
 	"""\
 	A simple dictionary which also stores the "times" an object was last updated.
 
 	Used so that we only upload/download items which have changed.
+
+	The keys which have been changed since the last call to clean() are kept in
+	dirty so that only they need to be written when the dictionary is saved.
+
+	Each of the watchers is called as watcher(dict, key, old time, old value)
+	after a key is set or removed (the old time is None and the old value is
+	missing if the key is new).
+
+	timesclass is the class used to store the modify times, a dictionary
+	unless given (ModTimes takes less memory for huge universes).
 	"""
-	def __init__(self):
+	timesclass = dict
+
+	def __init__(self, timesclass=None):
 		dict.__init__(self)
-		self.times = {}
-	
+		if timesclass is None:
+			timesclass = self.timesclass
+		self.times = timesclass()
+		self.dirty = set()
+		self.watchers = []
+
 	def __setitem__(self, key, value):
 		"""\
 		This set item is special, it only takes keys of the form,
@@ -20,14 +203,277 @@ class ChangeDict(dict):
 		else:
 			time = -1
 
-		if time != -1 and self.times.has_key(key) and self.times[key] > time:
-			raise ValueError("The object isn't new enough to update the dictionary with! Current %s, update %s" % (self.times[key], time))
-		
-		self.times[key] = time
+		times = self.times
+		if time != -1 and times.get(key, time) > time:
+			raise ValueError("The object isn't new enough to update the dictionary with! Current %s, update %s" % (times[key], time))
+
+		if self.watchers:
+			self.put(key, time, value)
+			return
+
+		times[key] = time
 		dict.__setitem__(self, key, value)
+		self.dirty.add(key)
 
 	def __delitem__(self, key):
+		if self.watchers:
+			oldtime, old = self.times.get(key), self.get(key, missing)
+
 		del self.times[key]
 		dict.__delitem__(self, key)
+		self.dirty.add(key)
+
+		for watcher in self.watchers:
+			watcher(self, key, oldtime, old)
+
+	def put(self, key, time, value):
+		"""\
+		Sets a value and the time it was modified without checking the time is
+		newer than the current one.
+		"""
+		if self.watchers:
+			oldtime, old = self.times.get(key), self.get(key, missing)
+
+		self.times[key] = time
+		dict.__setitem__(self, key, value)
+		self.dirty.add(key)
+
+		for watcher in self.watchers:
+			watcher(self, key, oldtime, old)
+
+	def update_many(self, triples):
+		"""\
+		Sets the values from a sequence of (key, time, value) triples.
+
+		Like setting each one, but the times are all checked before anything
+		is changed (so a ValueError leaves the dictionary untouched).
+		"""
+		triples = list(triples)
+
+		times = self.times
+		for key, time, value in triples:
+			if time != -1 and times.get(key, time) > time:
+				raise ValueError("The object isn't new enough to update the dictionary with! Current %s, update %s" % (times[key], time))
+
+		if self.watchers:
+			for key, time, value in triples:
+				self.put(key, time, value)
+			return
+
+		for key, time, value in triples:
+			times[key] = time
+		dict.update(self, [(key, value) for key, time, value in triples])
+		self.dirty.update([key for key, time, value in triples])
+
+	def stale_ids(self, pairs):
+		"""\
+		Returns the keys from (key, time) pairs (such as the IDs and modify
+		times from the server) which are missing or older than the time given.
+		"""
+		if hasattr(self.times, 'older'):
+			return self.times.older(pairs)
+
+		get = self.times.get
+		return [key for key, time in pairs if get(key, never) < time]
+
+	def touch(self, key):
+		"""\
+		Marks a key as changed when the value was modified in place.
+		"""
+		self.dirty.add(key)
+
+	def clean(self):
+		"""\
+		Forget which keys have changed.
+		"""
+		self.dirty.clear()
+
+	def restore(self, key, time, value):
+		"""\
+		Sets a value without checking the time, marking it as changed or
+		telling the watchers.
+
+		Used when loading saved data.
+		"""
+		self.times[key] = time
+		dict.__setitem__(self, key, value)
+
+	def discard(self, key):
+		"""\
+		Removes a value (if it exists) without marking it as changed.
+		"""
+		if self.times.has_key(key):
+			del self.times[key]
+			dict.__delitem__(self, key)
 
 ChangeDict.__repr__ = dict.__repr__
+
+class LazyChangeDict(ChangeDict):
+	"""\
+	A ChangeDict which can hold values which have not been decoded yet.
+
+	Values added with defer() are only decoded (by calling decode with the
+	key and the arguments given to defer) the first time they are accessed.
+	"""
+	def __init__(self, decode, timesclass=None):
+		ChangeDict.__init__(self, timesclass)
+		self.decode  = decode
+		self.pending = {}
+		self.lock    = threading.Lock()
+
+	def defer(self, key, time, *args):
+		"""\
+		Adds a value which has not been decoded yet.
+		"""
+		self.times[key] = time
+		dict.__setitem__(self, key, None)
+		self.pending[key] = args
+
+	def fetch(self, key):
+		"""\
+		Decodes a pending value.
+		"""
+		self.lock.acquire()
+		try:
+			args = self.pending.pop(key, None)
+			if args is None:
+				# Another thread got here first
+				return dict.__getitem__(self, key)
+
+			value = self.decode(key, *args)
+			dict.__setitem__(self, key, value)
+			return value
+		finally:
+			self.lock.release()
+
+	def resolve(self):
+		"""\
+		Decodes every pending value.
+		"""
+		for key in self.pending.keys():
+			self.fetch(key)
+
+	def __getitem__(self, key):
+		if key in self.pending:
+			return self.fetch(key)
+		return dict.__getitem__(self, key)
+
+	def get(self, key, default=None):
+		if key in self.pending:
+			return self.fetch(key)
+		return dict.get(self, key, default)
+
+	def forget(self, key):
+		"""\
+		Throws away a pending value which is about to be replaced.
+		"""
+		if self.watchers:
+			# The watchers need the old value
+			self.fetch(key)
+		self.pending.pop(key, None)
+
+	def __setitem__(self, key, value):
+		if key in self.pending:
+			self.forget(key)
+		ChangeDict.__setitem__(self, key, value)
+
+	def put(self, key, time, value):
+		if key in self.pending:
+			self.forget(key)
+		ChangeDict.put(self, key, time, value)
+
+	def update_many(self, triples):
+		triples = list(triples)
+		for key, time, value in triples:
+			if key in self.pending:
+				self.forget(key)
+		ChangeDict.update_many(self, triples)
+
+	def __delitem__(self, key):
+		if key in self.pending:
+			self.forget(key)
+		ChangeDict.__delitem__(self, key)
+
+	def restore(self, key, time, value):
+		self.pending.pop(key, None)
+		ChangeDict.restore(self, key, time, value)
+
+	def discard(self, key):
+		self.pending.pop(key, None)
+		ChangeDict.discard(self, key)
+
+	def values(self):
+		self.resolve()
+		return dict.values(self)
+
+	def items(self):
+		self.resolve()
+		return dict.items(self)
+
+	def itervalues(self):
+		for key in self:
+			yield self[key]
+
+	def iteritems(self):
+		for key in self:
+			yield key, self[key]
+
+	def pop(self, key, *args):
+		if self.has_key(key):
+			value = self[key]
+			del self[key]
+			return value
+		return dict.pop(self, key, *args)
+
+	def copy(self):
+		self.resolve()
+		return dict.copy(self)
+
+	def __repr__(self):
+		self.resolve()
+		return dict.__repr__(self)
+
+if __name__ == "__main__":
+	# Compare the ModTimes with keeping the times in a normal dictionary
+	import sys
+	import time
+	import random
+
+	class CompactChangeDict(ChangeDict):
+		timesclass = ModTimes
+
+	def size(times):
+		if isinstance(times, dict):
+			return sys.getsizeof(times) + sum([sys.getsizeof(t) for t in times.itervalues()])
+		return sys.getsizeof(times.dense) + sys.getsizeof(times.sparse)
+
+	# The IDs arrive in modify time order, which is not the order of the IDs
+	random.seed(0)
+	for number in (1000, 10000, 100000):
+		ascending = range(number)
+		descending = list(reversed(ascending))
+		shuffled = list(ascending)
+		random.shuffle(shuffled)
+
+		for order, keys in (("ascending", ascending), ("descending", descending), ("random", shuffled)):
+			for cls in (ChangeDict, CompactChangeDict):
+				d = cls()
+				start = time.time()
+				for i in keys:
+					d[i] = (1234567890.0+i, i)
+				for i in keys:
+					d[i] = (1234567891.0+i, i)
+				taken = time.time()-start
+
+				start = time.time()
+				for i in keys:
+					d.times[i]
+				lookup = time.time()-start
+
+				pairs = [(i, 1234567891.0+i+(i%2)) for i in keys]
+				start = time.time()
+				d.stale_ids(pairs)
+				stale = time.time()-start
+
+				print "%-10s %7i entries %-10s: set %.3fus, time lookup %.3fus, stale_ids %.3fms, times take %8i bytes" % (
+					cls.timesclass.__name__, number, order, taken/(number*2)*1e6, lookup/number*1e6, stale*1e3, size(d.times))
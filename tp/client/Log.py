@@ -1,3 +1,427 @@
 """\
 A Log is a version of the Cache which can have changes which happen undone and previous versions can be viewed.
+
+The Log does not copy the cache, it watches the cache's dictionaries and
+remembers the old and new value for every change. As the cache never changes
+a value in place, the old values are shared with whatever held them before so
+undoing (or viewing the cache before) a batch of changes only costs as much as
+the changes themselves.
+
+Undoing only changes the local cache, nothing is ever sent to the server.
+
+A History keeps the cache as it was at the end of each turn in the same way.
 """
+
+# Python imports
+import bisect
+
+# Local imports
+from ChangeDict import missing
+
+class Batch(list):
+	"""\
+	A group of changes which are undone together.
+
+	Each change is a tuple of,
+		(store name, key, old time, old value, new time, new value)
+	"""
+	def __init__(self, label=None):
+		list.__init__(self)
+		self.label = label
+
+	def __repr__(self):
+		return "<Batch %r of %s changes>" % (self.label, len(self))
+
+class Watcher(object):
+	"""\
+	Base for things which watch the Cache's dictionaries.
+
+	record(dict, store name, key, old time, old value) is called for each
+	change.
+	"""
+	# The names of the dictionaries to watch, None for all of them
+	stores = None
+
+	def attach(self):
+		"""\
+		Starts watching the cache's dictionaries.
+
+		Must be called again if the cache creates new dictionaries (for
+		example when it is loaded).
+		"""
+		self.detach()
+		for name in self.stores or self.cache.stores:
+			def watcher(d, key, oldtime, old, self=self, name=name):
+				self.record(d, name, key, oldtime, old)
+
+			getattr(self.cache, name).watchers.append(watcher)
+			self.watchers[name] = watcher
+
+	def detach(self):
+		"""\
+		Stops watching the cache.
+		"""
+		for name, watcher in self.watchers.items():
+			watchers = getattr(self.cache, name).watchers
+			if watcher in watchers:
+				watchers.remove(watcher)
+		self.watchers = {}
+
+	def record(self, d, name, key, oldtime, old):
+		pass
+
+class Log(Watcher):
+	"""\
+	Remembers the changes made to a Cache so they can be undone and redone.
+
+	Changes are grouped into batches, a batch is started with begin(label) and
+	finished with end(). Changes made outside a batch are put in an unlabelled
+	batch which lasts until the next call to begin.
+
+	Only the last depth batches, and no more than size changes altogether, are
+	kept. A batch of more than size changes (such as downloading the whole
+	universe with Cache.update) is too big to keep, so it can't be undone and
+	nor can anything before it.
+
+	Undoing and redoing only change the local cache, to change the game the
+	changes must be sent to the server as well.
+	"""
+	depth = 100
+	size  = 10000
+
+	def __init__(self, cache, depth=None, size=None):
+		if depth is not None:
+			self.depth = depth
+		if size is not None:
+			self.size = size
+
+		self.cache   = cache
+		self.undos   = []
+		self.redos   = []
+		self.current = None
+		# The number of changes in the batches which can be undone
+		self.count   = 0
+		# Set when the current batch got too big to keep
+		self.overflowed = False
+
+		# Set while undoing or redoing so the changes are not recorded
+		self.replaying = False
+
+		self.watchers = {}
+		self.attach()
+
+	def record(self, d, name, key, oldtime, old):
+		if self.replaying:
+			return
+
+		# Anything which was undone can no longer be redone
+		del self.redos[:]
+
+		if self.overflowed:
+			return
+
+		if self.current is None:
+			self.current = Batch()
+		self.current.append((name, key, oldtime, old, d.times.get(key), d.get(key, missing)))
+
+		if len(self.current) > self.size:
+			# Nothing before this batch can be undone without undoing it
+			self.current = None
+			self.undos   = []
+			self.count   = 0
+			self.overflowed = True
+
+	def begin(self, label=None):
+		"""\
+		Starts a new batch of changes.
+		"""
+		self.end()
+		self.current = Batch(label)
+
+	def end(self):
+		"""\
+		Finishes the current batch of changes.
+		"""
+		if self.current is not None and len(self.current) > 0:
+			self.undos.append(self.current)
+			self.count += len(self.current)
+			while len(self.undos) > self.depth or self.count > self.size:
+				self.count -= len(self.undos.pop(0))
+		self.current = None
+		self.overflowed = False
+
+	def replay(self, batch, undo):
+		self.replaying = True
+		try:
+			if undo:
+				changes = reversed(batch)
+			else:
+				changes = batch
+
+			for name, key, oldtime, old, newtime, new in changes:
+				if not undo:
+					oldtime, old = newtime, new
+
+				d = getattr(self.cache, name)
+				if old is missing:
+					if d.has_key(key):
+						del d[key]
+				else:
+					d.put(key, oldtime, old)
+		finally:
+			self.replaying = False
+
+	def undo(self):
+		"""\
+		Undoes the last batch of changes, returning the batch.
+
+		Returns None if there is nothing to undo. Only the local cache is
+		changed, the server never finds out.
+		"""
+		self.end()
+		if len(self.undos) == 0:
+			return None
+
+		batch = self.undos.pop()
+		self.count -= len(batch)
+		self.replay(batch, True)
+		self.redos.append(batch)
+		return batch
+
+	def redo(self):
+		"""\
+		Redoes the last batch of changes which was undone, returning the batch.
+
+		Returns None if there is nothing to redo.
+		"""
+		if len(self.redos) == 0:
+			return None
+
+		self.end()
+		batch = self.redos.pop()
+		self.replay(batch, False)
+		self.undos.append(batch)
+		self.count += len(batch)
+		return batch
+
+	def batches(self):
+		"""\
+		Returns every batch which can be undone, newest first.
+		"""
+		batches = list(self.undos)
+		if self.current is not None and len(self.current) > 0:
+			batches.append(self.current)
+		batches.reverse()
+		return batches
+
+	def view(self, label):
+		"""\
+		Returns a read only View of the cache as it was before the newest batch
+		with the given label.
+		"""
+		older = {}
+		for batch in self.batches():
+			for name, key, oldtime, old, newtime, new in reversed(batch):
+				older[(name, key)] = (oldtime, old)
+
+			if batch.label == label:
+				return View(self.cache, older)
+
+		raise KeyError("No batch labelled %r is remembered." % (label,))
+
+class StoreView(object):
+	"""\
+	A read only version of one of the Cache's dictionaries with some of the
+	values replaced by older ones.
+	"""
+	def __init__(self, d, older):
+		self.d     = d
+		self.older = older
+
+	def __getitem__(self, key):
+		if self.older.has_key(key):
+			value = self.older[key][1]
+			if value is missing:
+				raise KeyError(key)
+			return value
+		return self.d[key]
+
+	def get(self, key, default=None):
+		try:
+			return self[key]
+		except KeyError:
+			return default
+
+	def has_key(self, key):
+		if self.older.has_key(key):
+			return not self.older[key][1] is missing
+		return self.d.has_key(key)
+	__contains__ = has_key
+
+	def time(self, key):
+		"""\
+		Returns the modify time of a key.
+		"""
+		if self.older.has_key(key):
+			return self.older[key][0]
+		return self.d.times[key]
+
+	def keys(self):
+		return [key for key in self]
+
+	def __iter__(self):
+		for key in self.d:
+			if not self.older.has_key(key):
+				yield key
+		for key, (time, value) in self.older.iteritems():
+			if not value is missing:
+				yield key
+
+	def __len__(self):
+		return len(self.keys())
+
+	def values(self):
+		return [self[key] for key in self]
+
+	def items(self):
+		return [(key, self[key]) for key in self]
+
+class View(object):
+	"""\
+	A read only version of the Cache as it was at some point in the past.
+
+	The stores are available as attributes like the Cache (view.objects etc).
+	"""
+	def __init__(self, cache, older):
+		self.cache = cache
+
+		stores = {}
+		for (name, key), change in older.iteritems():
+			stores.setdefault(name, {})[key] = change
+
+		for name in cache.stores:
+			setattr(self, name, StoreView(getattr(cache, name), stores.get(name, {})))
+
+class History(Watcher):
+	"""\
+	Remembers the Cache as it was at the end of each turn.
+
+	Call mark(turn) each time the cache has been updated for a new turn. Only
+	the entries which changed since the last mark are remembered again, so
+	everything which did not change is shared between the turns.
+	"""
+	def __init__(self, cache):
+		self.cache = cache
+
+		# The turns which have been marked, in order
+		self.turns    = []
+		# (store name, key) -> ([turn, ...], [(time, value), ...])
+		self.versions = {}
+		# turn -> set of (store name, key) which changed in that turn
+		self.changed  = {}
+		# (store name, key) which have changed since the last mark
+		self.dirty    = set()
+
+		self.watchers = {}
+		self.attach()
+
+	def record(self, d, name, key, oldtime, old):
+		self.dirty.add((name, key))
+
+	def mark(self, turn):
+		"""\
+		Remembers the cache as it is now as the given turn.
+		"""
+		if len(self.turns) > 0 and turn <= self.turns[-1]:
+			raise ValueError("Turn %s is not after the last turn marked (%s)." % (turn, self.turns[-1]))
+
+		if len(self.turns) == 0:
+			# Everything is new on the first turn
+			keys = set(self.dirty)
+			for name in self.cache.stores:
+				for key in getattr(self.cache, name).keys():
+					keys.add((name, key))
+		else:
+			keys = self.dirty
+
+		changed = set()
+		for name, key in keys:
+			d = getattr(self.cache, name)
+			value = d.get(key, missing)
+
+			turns, values = self.versions.setdefault((name, key), ([], []))
+			if len(values) > 0 and values[-1][1] is value:
+				# Changed and then changed back
+				continue
+			if len(values) == 0 and value is missing:
+				continue
+
+			turns.append(turn)
+			values.append((d.times.get(key), value))
+			changed.add((name, key))
+
+		self.turns.append(turn)
+		self.changed[turn] = changed
+		self.dirty = set()
+
+	def version(self, name, key, turn):
+		"""\
+		Returns (time, value) of an entry as of the given turn.
+
+		The value is missing if the entry didn't exist at that turn.
+		"""
+		if not self.versions.has_key((name, key)):
+			if len(self.turns) > 0 and turn >= self.turns[0]:
+				return (None, missing)
+			raise KeyError("Turn %s is before the first turn marked." % (turn,))
+
+		turns, values = self.versions[(name, key)]
+		i = bisect.bisect_right(turns, turn)
+		if i == 0:
+			if turn >= self.turns[0]:
+				return (None, missing)
+			raise KeyError("Turn %s is before the first turn marked." % (turn,))
+		return values[i-1]
+
+	def get(self, name, key, turn, default=None):
+		"""\
+		Returns an entry of one of the cache's dictionaries as of the given
+		turn (or default if it didn't exist then).
+
+		For example,
+			history.get("objects", 23, 5)
+		"""
+		value = self.version(name, key, turn)[1]
+		if value is missing:
+			return default
+		return value
+
+	def diff(self, name, old, new):
+		"""\
+		Returns the changes to one of the cache's dictionaries between two
+		turns as a dictionary of,
+			key -> (value at old turn, value at new turn)
+
+		An entry which didn't exist at one of the turns has the value missing.
+
+		Only the entries changed in the turns between are looked at.
+		"""
+		if old > new:
+			raise ValueError("The old turn (%s) is after the new turn (%s)." % (old, new))
+
+		start = bisect.bisect_right(self.turns, old)
+		end   = bisect.bisect_right(self.turns, new)
+
+		keys = set()
+		for turn in self.turns[start:end]:
+			for what, key in self.changed[turn]:
+				if what == name:
+					keys.add(key)
+
+		result = {}
+		for key in keys:
+			before = self.version(name, key, old)[1]
+			after  = self.version(name, key, new)[1]
+			if not before is after:
+				result[key] = (before, after)
+		return result
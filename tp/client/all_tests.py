@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+"""Harness to run all the tests of the client library."""
+import unittest
+
+def suite():
+    moduleNames = ['test_changedict',
+                   'test_cache',
+                   'test_log',
+                   'test_spatial',
+                   'test_progress',
+                   ]
+
+    suite = unittest.TestSuite()
+    loader = unittest.defaultTestLoader
+    for n in moduleNames:
+        testCase = loader.loadTestsFromModule(__import__(n))
+        suite.addTest(testCase)
+    return suite
+
+
+if __name__ == '__main__':
+    suite = suite()
+    runner = unittest.TextTestRunner()
+    runner.run(suite)
@@ -5,39 +5,41 @@ import copy
 import base64
 import pprint
 import struct
+import marshal
 import cPickle as pickle
-from datetime import datetime
-def df(time):
-	if type(time) in (float, int, long):
-		return datetime.utcfromtimestamp(time).strftime('%c')
-	elif type(time) is datetime:
-		return time.strftime('%c')
-	else:
-		raise TypeError("Unable to output this type...")
-
-try:
-	set()
-except NameError:
-	from sets import Set as set
+from collections import deque
 
 # Other library imports
 from tp.netlib import Connection, failed, constants
-from tp.netlib.objects import Header, Description, OrderDescs, DynamicBaseOrder
+from tp.netlib.objects import OrderDescs, DynamicBaseOrder
 
 # Local imports
-from ChangeDict import ChangeDict
+from ChangeDict import ChangeDict, LazyChangeDict, ModTimes, missing
+from pipeline import Pipeline
+import journal
+import migrate
+import cachedb
+import index
+import progress
+from progress import df
+
+def chunks(l, size):
+	"""\
+	Splits a list into lists of at most size items.
+	"""
+	return [l[i:i+size] for i in range(0, len(l), size)]
 
 class Cache(object):
 	"""\
 	This is the a cache of the data downloaded from the network. 
 
-	It can be pickled and restored at a later date to preserve the data accross application runs.
+	It can be saved and restored at a later date to preserve the data accross application runs.
 
 	To update the cache you use CacheDirtyEvents in the following way...
 		
 
 	"""
-	version = 3
+	version = 7
 
 	class CacheEvent(object):
 		"""\
@@ -99,6 +101,18 @@ class Cache(object):
 			else:
 				CacheEvent.__init__(self, what, *args, **kw)
 
+	class CacheRollbackEvent(CacheUpdateEvent):
+		"""\
+		Raised when a change which was applied before the server accepted it
+		(see Cache.optimistic) had to be undone. Contains a reference to what
+		was rolled back.
+		"""
+		def __init__(self, what, id, error=None):
+			self.what   = what
+			self.action = "change"
+			self.id     = id
+			self.error  = error
+
 	# Read Only things can only be updated via the network
 	readonly = ("features", "objects", "orders_probe", "boards", "resources", "components", "properties", "players", "resources")
 	# These can be updated via either side
@@ -107,6 +121,25 @@ class Cache(object):
 	actions = ("create", "remove", "change")
 	compound = ("orders", "messages")
 
+	# The ChangeDicts which are stored on disk
+	stores = ("objects", "orders", "orders_probe", "boards", "messages", "categories", "designs", "components", "properties", "players", "resources")
+	# Other attributes which are stored on disk
+	attributes = ("features", "descriptions", "phase")
+	# Where the cache can be stored on disk
+	backends = ("journal", "sqlite")
+
+	# Secondary indexes (name, index class, store, function), see find()
+	indexes = (
+		("owner",    index.Index, "objects",  index.attribute("owner")),
+		("subtype",  index.Index, "objects",  index.attribute("subtype")),
+		("parent",   index.Index, "objects",  index.attribute("parent")),
+	)
+
+	# Number of IDs to ask for in each get request
+	chunk = 50
+	# Number of entries to download between saves while updating
+	checkpoints = 1000
+
 	def key(server, username):
 		key = server
 
@@ -141,14 +174,38 @@ class Cache(object):
 		return os.path.join(base, extra)
 	configdir = staticmethod(configdir)
 
-	def __init__(self, key, configdir=None, new=False):
+	def __init__(self, key, configdir=None, new=False, lazy=False, compress=None, level=None, backend="journal", compact=False):
 		"""\
 		It is important that key constructed the following way,
 
 		protocol://username@server:port/
 
 		Everything must be there, even if the port is the default.
+
+		If lazy is True the saved cache is memory mapped and each object, order
+		or message is only decoded the first time it is accessed.
+
+		compress is the codec (see journal.codecs) to compress the saved cache
+		with and level the compression level to use. (A compressed cache is
+		decompressed into memory when loaded, even if lazy.) A cache saved with
+		a different compression is converted the next time the journal is
+		compacted (or a snapshot is written).
+
+		backend is where the cache is saved,
+			journal	- A snapshot file and a journal of changes (see journal)
+			sqlite	- An SQLite database (see cachedb), entries are always
+					  only read when they are first accessed
+
+		If compact is True the modify times are kept in arrays (see
+		ChangeDict.ModTimes) rather than dictionaries. This takes less memory
+		for huge universes but makes getting and setting slower.
 		"""
+		if not backend in self.backends:
+			raise ValueError("Unknown backend %s (can use %s)" % (backend, ", ".join(self.backends)))
+
+		self.lazy = lazy
+		self.compact = compact
+
 		if configdir == None:
 			configdir = Cache.configdir()
 
@@ -157,40 +214,96 @@ class Cache(object):
 
 		key = Cache.configkey(key)
 
-		self.file = os.path.join(configdir, "cache.%s" % (key,))
+		if backend == "sqlite":
+			self.file = os.path.join(configdir, "cache.%s.db" % (key,))
+			self.journal = None
+			self.database = cachedb.Database(self.file, self.version, self.compound)
+		else:
+			self.file = os.path.join(configdir, "cache.%s" % (key,))
+			self.journal = journal.Journal(self.file, self.version, compress, level)
+			self.database = None
+
 		if os.path.exists(self.file) and not new:
 			# Load the previously cached status
 			print "Loading previous saved data (from %s)." % (self.file,)
 			try:
 				self.load()
 				return
-			except (IOError, EOFError), e:
+			except (IOError, EOFError, ValueError, struct.error, pickle.UnpicklingError, cachedb.Error), e:
 				print e
 				print "Unable to load the data, saved cache must be corrupt."
 		print "Creating the Cache fresh (%s)." % (self.file,)
 		self.new()
 
 	def new(self):
+		# Nothing has been written to disk yet
+		self.saved = False
+
 		# Features
 		self.features		= []
 
+		# The modify times of the registered order descriptions
+		self.descriptions	= {}
+
+		# The phase an unfinished update got up to
+		self.phase			= None
+		self.unsaved		= 0
+
+		# The payloads of the descriptions and attributes last saved,
+		# (kind, what, id) -> payload
+		self.written		= {}
+
+		# The number of changes waiting for the server for each (what, id)
+		self.pending		= {}
+
+		# The universe tree, child id -> parent id (built when first needed)
+		self.parents		= None
+		# The objects which need their parent set
+		self.unstamped		= set()
+
 		# The object stuff
-		self.objects		= ChangeDict()
-		self.orders			= ChangeDict()
-		self.orders_probe	= ChangeDict()
+		self.objects		= self.changedict("objects")
+		self.objects.watchers.append(self.relink)
+		self.orders			= self.changedict("orders")
+		self.orders_probe	= self.changedict("orders_probe")
 
 		# The message boards
-		self.boards			= ChangeDict()
-		self.messages		= ChangeDict()
+		self.boards			= self.changedict("boards")
+		self.messages		= self.changedict("messages")
 
 		# Design stuff
-		self.categories		= ChangeDict()
-		self.designs		= ChangeDict()
-		self.components		= ChangeDict()
-		self.properties		= ChangeDict()
+		self.categories		= self.changedict("categories")
+		self.designs		= self.changedict("designs")
+		self.components		= self.changedict("components")
+		self.properties		= self.changedict("properties")
 
-		self.players		= ChangeDict()
-		self.resources		= ChangeDict()
+		self.players		= self.changedict("players")
+		self.resources		= self.changedict("resources")
+
+		self.indexed = {}
+		for name, cls, store, function in self.indexes:
+			self.indexed[name] = cls(self, store, function)
+
+	def changedict(self, name):
+		"""\
+		Returns an empty ChangeDict to store name in.
+		"""
+		timesclass = None
+		if getattr(self, 'compact', False):
+			timesclass = ModTimes
+
+		if getattr(self, 'database', None) is not None:
+			return LazyChangeDict(self.database.decoder(name), timesclass)
+		if not getattr(self, 'lazy', False):
+			return ChangeDict(timesclass)
+
+		compound = name in self.compound
+		def decode(id, buffer, offset, length, stripped, compound=compound):
+			value = journal.decode(compound, buffer[offset:offset+length])
+			if stripped:
+				journal.unstrip(compound, value, id)
+			return value
+		return LazyChangeDict(decode, timesclass)
 
 	def apply(self, evt):
 		"""\
@@ -206,15 +319,17 @@ class Cache(object):
 			elif evt.action == "remove":
 				del getattr(self, evt.what)[evt.id]
 		else:
-			d = getattr(self, evt.what)[evt.id]
+			# Values are never changed in place (so old versions can be kept
+			# cheaply, see Log) so the changes are made to a new list.
+			cd = getattr(self, evt.what)
+			d = list(cd[evt.id])
+			number = 0
 			if evt.action == "create":
 				if evt.slot == -1:
 					d.append(evt.change)
 				else:
 					d.insert(evt.slot, evt.change)
-
-				if evt.what is "orders":
-					self.objects[evt.id].order_number += 1
+				number = 1
 
 			elif evt.action == "change":
 				d[evt.slot] = evt.change
@@ -223,86 +338,515 @@ class Cache(object):
 					evt.slot = [evt.slot]
 				for slot in evt.slot:
 					del d[slot]
+					number -= 1
+
+			cd[evt.id] = (cd.times[evt.id], d)
 
-					if evt.what is "orders":
-						self.objects[evt.id].order_number -= 1
+			if evt.what is "orders" and number != 0:
+				object = copy.copy(self.objects[evt.id])
+				object.order_number += number
+				self.objects[evt.id] = (self.objects.times[evt.id], object)
+
+		if len(self.unstamped) > 0:
+			self.stamp()
 
 		evt.__class__ = self.CacheUpdateEvent
 
-	def load(self):
+	def tree(self):
+		"""\
+		Returns the universe tree as a dictionary of child id -> parent id.
+
+		The tree is built from the objects the first time it is needed, after
+		that it is kept up to date as objects change.
+		"""
+		if self.parents is None:
+			parents = {}
+			for id, object in self.objects.iteritems():
+				for child in object.contains:
+					parents[child] = id
+			self.parents = parents
+
+			# Check every object has the right parent
+			self.unstamped = set(self.objects.keys())
+		return self.parents
+
+	def relink(self, d, id, oldtime, old):
+		"""\
+		Watches the objects and updates the universe tree when an object's
+		contents change.
+		"""
+		if self.parents is None:
+			return
+
+		object = d.get(id, None)
+
+		before = getattr(old, 'contains', [])
+		after  = getattr(object, 'contains', [])
+		if before != after:
+			for child in before:
+				if self.parents.get(child, None) == id:
+					del self.parents[child]
+					self.unstamped.add(child)
+			for child in after:
+				self.parents[child] = id
+				self.unstamped.add(child)
+
+		if not object is None and getattr(object, 'parent', None) != self.parents.get(id, None):
+			self.unstamped.add(id)
+
+	def stamp(self):
+		"""\
+		Sets parent on each object whose parent has changed.
+		"""
+		parents = self.tree()
+
+		unstamped, self.unstamped = self.unstamped, set()
+		for id in unstamped:
+			object = self.objects.get(id, None)
+			if object is None:
+				continue
+
+			parent = parents.get(id, None)
+			if getattr(object, 'parent', None) != parent:
+				object = copy.copy(object)
+				object.parent = parent
+				self.objects[id] = (self.objects.times[id], object)
+
+	def find(self, name, key):
 		"""\
+		Looks up a key in one of the secondary indexes.
+
+		For example,
+			cache.find("owner", 3)		- The IDs of the objects owned by player 3
+			cache.find("subtype", 2)	- The IDs of the objects of type 2
+			cache.find("parent", 10)	- The IDs of the objects inside object 10
 		"""
-		f = open(self.file, 'rb')
+		return self.indexed[name][key]
 
-		# Read in the version number
-		v, = struct.unpack('!I', f.read(4))
-		if v != self.version:
-			raise IOError("The cache is not of this version! (It's version %s)" % (v,))
+	def owned(self, owner):
+		"""\
+		Returns the IDs of the objects owned by a player.
+		"""
+		return self.find("owner", owner)
 
-		# First load the pickle
-		self.__dict__ = pickle.load(f)
+	def oftype(self, subtype):
+		"""\
+		Returns the IDs of the objects of a type.
+		"""
+		return self.find("subtype", subtype)
 
-		# Now load the order cache
-		self.orders = ChangeDict()
-		while True:
-			d = f.read(Header.size)
-			if len(d) != Header.size:
-				if len(d) != 0:
-					raise IOError("Garbage was found at the end!")
+	def children(self, id):
+		"""\
+		Returns the IDs of the objects whose parent is an object.
+		"""
+		return self.find("parent", id)
+
+	def ancestors(self, id):
+		"""\
+		Returns the IDs of the objects which contain an object, its parent
+		first and the top of the universe last.
+		"""
+		parents = self.tree()
+
+		result = []
+		while parents.has_key(id):
+			id = parents[id]
+			if id in result:
+				# Loops should not happen but don't hang if they do
 				break
+			result.append(id)
+		return result
+
+	def descendants(self, id):
+		"""\
+		Returns the IDs of every object inside an object.
+		"""
+		result = []
+		seen = set([id])
 
-			p = Header.fromstr(d)
+		stack = [id]
+		while len(stack) > 0:
+			object = self.objects.get(stack.pop(), None)
+			if object is None:
+				continue
 
-			d = f.read(p.length)
-			p.__process__(d)
+			children = [child for child in object.contains if not child in seen]
+			seen.update(children)
+			result.extend(children)
+			stack.extend(children)
+		return result
 
-			# Descriptions
-			if isinstance(p, Description):
-				p.register()
-			# Orders
-			else:
-				# Get the ID number
-				id, = struct.unpack('!Q', f.read(8))
+	def subtree(self, id):
+		"""\
+		Returns the object and every object inside it.
+		"""
+		result = []
+		for id in [id] + self.descendants(id):
+			if self.objects.has_key(id):
+				result.append(self.objects[id])
+		return result
+
+	def optimistic(self, evt):
+		"""\
+		Applies a CacheDirtyEvent straight away, before the server has seen it.
+
+		The change is marked as pending and the CacheUpdateEvent to post is
+		returned. The event itself should then be sent to the server as
+		normal, once the server has answered the network side calls confirm()
+		or rollback() with it.
+		"""
+		if not isinstance(evt, self.CacheDirtyEvent):
+			raise TypeError("I can only accept CacheDirtyEvents")
+
+		d = getattr(self, evt.what)
+
+		# Remember enough to undo the change
+		if d.has_key(evt.id):
+			evt.undo = (d.times[evt.id], d[evt.id])
+		else:
+			evt.undo = None
+		evt.local   = (evt.id, getattr(evt, 'change', None))
+		evt.pending = True
+
+		# Appending needs to happen at the same slot on the server
+		if evt.what in self.compound and evt.action == "create" and evt.slot == -1:
+			evt.slot = len(d[evt.id])
+
+		key = (evt.what, evt.id)
+		self.pending[key] = self.pending.get(key, 0) + 1
+
+		update = copy.copy(evt)
+		self.apply(update)
+		return update
+
+	def ispending(self, what, id):
+		"""\
+		Returns True if there are changes to what/id which the server hasn't
+		accepted yet.
+		"""
+		return self.pending.has_key((what, id))
+
+	def settle(self, evt):
+		"""\
+		Marks a pending change as no longer waiting for the server.
+		"""
+		key = (evt.what, evt.local[0])
+		if self.pending.has_key(key):
+			self.pending[key] -= 1
+			if self.pending[key] <= 0:
+				del self.pending[key]
+		evt.pending = False
+
+	def confirm(self, evt):
+		"""\
+		Called with a pending CacheDirtyEvent once the server accepted it.
+
+		The local copy of the change is replaced with the one the server sent
+		back. The event is mutated into a CacheUpdateEvent.
+		"""
+		localid, local = evt.local
+		d = getattr(self, evt.what)
+
+		if evt.what in self.compound:
+			if evt.action in ("create", "change") and d.has_key(evt.id):
+				l = d[evt.id]
+				for slot in range(0, len(l)):
+					if l[slot] is local:
+						l = list(l)
+						l[slot] = evt.change
+						d[evt.id] = (d.times[evt.id], l)
+						break
+		elif evt.action in ("create", "change"):
+			# The server may have given the change a new ID
+			if localid != evt.id and d.has_key(localid):
+				del d[localid]
+			d[evt.id] = (-1, evt.change)
+
+		self.settle(evt)
+		evt.__class__ = self.CacheUpdateEvent
+
+	def rollback(self, evt, error=None):
+		"""\
+		Called with a pending CacheDirtyEvent when the server rejected it.
+
+		The cache is put back the way it was before the change was applied.
+		The event is mutated into a CacheRollbackEvent.
+		"""
+		localid, local = evt.local
+		d = getattr(self, evt.what)
+
+		if evt.undo is None:
+			if d.has_key(localid):
+				del d[localid]
+		else:
+			d.put(localid, *evt.undo)
+
+			if evt.what == "orders" and self.objects.has_key(localid):
+				object = copy.copy(self.objects[localid])
+				object.order_number = len(evt.undo[1])
+				self.objects[localid] = (self.objects.times[localid], object)
+
+		self.settle(evt)
+		evt.__class__ = self.CacheRollbackEvent
+		evt.id    = localid
+		evt.error = error
+
+	def load(self):
+		"""\
+		Loads the snapshot and replays the journal on top of it (or loads the
+		database).
+
+		A cache saved by an older version is converted (see migrate) and saved
+		again in the current format.
+		"""
+		self.new()
 
-				if not self.orders.has_key(id):
-					self.orders[id] = (self.objects.times[id], [])
-				self.orders[id].append(p)
+		if self.database is not None:
+			self.database.load(self)
+			version = self.version
+		else:
+			version = self.journal.fileversion()
+			if version == self.version:
+				records = self.journal.load()
+			else:
+				print "Converting the cache from version %s." % (version,)
+				records = migrate.records(self, version)
+			self.replay(records)
 
 		for id in self.objects.keys():
 			if not self.orders.has_key(id):
-				self.orders[id] = (self.objects.times[id], [])
+				self.orders.restore(id, self.objects.times[id], [])
 
-		#pprint.pprint(self.__dict__)
+		# The first save of a converted cache replaces the old files
+		self.saved = version == self.version
+		if not self.saved:
+			self.save()
 
-	def save(self):
+	def replay(self, records):
 		"""\
+		Sets the entries and attributes from the records of the journal.
 		"""
-		#pprint.pprint(self.__dict__)
+		# hash -> (buffer, offset, length) of each blob
+		blobs = {}
+		for kind, what, id, time, buffer, offset, length in records:
+			stripped = False
+			if kind == journal.BLOB:
+				digest = buffer[offset:offset+journal.digestsize]
+				blobs[digest] = (buffer, offset+journal.digestsize, length-journal.digestsize)
+				continue
+			elif kind == journal.HASHED:
+				digest, stripped = journal.dereference(buffer[offset:offset+length])
+				if not blobs.has_key(digest):
+					raise IOError("The cache refers to a missing blob!")
+				kind = journal.SET
+				buffer, offset, length = blobs[digest]
+
+			if kind == journal.SET and self.lazy:
+				getattr(self, what).defer(id, time, buffer, offset, length, stripped)
+				continue
 
-		# Save the cache
-		f = open(self.file, 'wb')
-		f.write(struct.pack('!I', self.version))
+			data = buffer[offset:offset+length]
+
+			if kind == journal.SET:
+				compound = what in self.compound
+				value = journal.decode(compound, data)
+				if stripped:
+					journal.unstrip(compound, value, id)
+				getattr(self, what).restore(id, time, value)
+			elif kind == journal.DELETE:
+				getattr(self, what).discard(id)
+			elif kind == journal.ATTRIBUTE:
+				setattr(self, what, marshal.loads(data))
+				self.written[(kind, what, id)] = data
+			elif kind == journal.DESCRIPTION:
+				for desc in journal.frames(data):
+					desc.register()
+				self.written[(kind, what, id)] = data
+			else:
+				raise IOError("Unknown record (%r) found in the cache!" % (kind,))
 
-		p = copy.copy(self.__dict__)
-		del p['orders']
-		pickle.dump(p, f)
+	def extras(self, all=False):
+		"""\
+		Returns (kind, what, id, payload) of each dynamic order description and
+		attribute which needs saving.
 
-		# Save each dynamic order description
+		If all is False only those which have changed since the last save are
+		included.
+		"""
+		extras = []
 		for orderdesc in OrderDescs().values():
-			#print orderdesc, type(orderdesc), issubclass(orderdesc, DynamicBaseOrder)
 			if issubclass(orderdesc, DynamicBaseOrder):
-				f.write(str(orderdesc.packet))
+				extras.append((journal.DESCRIPTION, "", orderdesc.packet.id, str(orderdesc.packet)))
+		for name in self.attributes:
+			extras.append((journal.ATTRIBUTE, name, 0, marshal.dumps(getattr(self, name))))
+
+		if all:
+			self.written = {}
+
+		changed = []
+		for kind, what, id, payload in extras:
+			if self.written.get((kind, what, id), None) != payload:
+				self.written[(kind, what, id)] = payload
+				changed.append((kind, what, id, payload))
+		return changed
+
+	def records(self, all=False, blobs=None):
+		"""\
+		Returns the records needed to save the cache.
+
+		If all is False only the entries (and attributes and order descriptions)
+		which have changed since the last save are included. blobs is given to
+		journal.Journal.hashed.
+
+		Which entries to save is worked out straight away, but they are only
+		encoded as the records are used. As values are never changed in place
+		the records can be made by another thread while the cache changes.
+		"""
+		entries = []
+		for name in self.stores:
+			d = getattr(self, name)
+
+			# Values which were never decoded can be written out as they are
+			pending = getattr(d, 'pending', {})
+
+			if all:
+				keys = d.keys()
+			else:
+				keys = list(d.dirty)
+
+			for id in keys:
+				if pending.has_key(id):
+					entries.append((name, id, d.times[id], missing, pending[id]))
+				elif d.has_key(id):
+					entries.append((name, id, d.times[id], d[id], None))
+				else:
+					entries.append((name, id, -1, missing, None))
+
+		return self._records(self.extras(all), entries, blobs)
+
+	def _records(self, extras, entries, blobs):
+		for kind, what, id, payload in extras:
+			yield journal.pack(kind, what, id, -1, payload)
+
+		for name, id, time, value, raw in entries:
+			if raw is not None:
+				buffer, offset, length, stripped = raw
+				yield self.journal.hashed(name, id, time, buffer[offset:offset+length], stripped, blobs)
+			elif value is not missing:
+				compound = name in self.compound
+				value, stripped = journal.strip(compound, value, id)
+				yield self.journal.hashed(name, id, time, journal.encode(compound, value), stripped, blobs)
+			else:
+				yield journal.pack(journal.DELETE, name, id, -1, "")
+
+	def checkpoint(self, phase=False):
+		"""\
+		Records the progress of an update so it can be resumed if it fails.
+
+		Called with the name of each phase as it starts (and None when the
+		update is finished), which always saves the cache. Called without a
+		phase every downloaded entry is counted and the cache saved every
+		checkpoints entries.
+		"""
+		if phase is not False:
+			self.phase = phase
+		else:
+			self.unsaved += 1
+			if self.unsaved < self.checkpoints:
+				return
+		self.save()
+
+	def save(self):
+		"""\
+		Saves the cache to disk.
+
+		Only the entries which have changed since the last save are appended to
+		the journal. The first save of a new cache writes a complete snapshot.
+
+		The records to save are made (or for a snapshot encoded) and written to
+		disk in the background (see flush). If writing a save failed, the next
+		save writes a complete snapshot again.
+
+		With the sqlite backend the changed entries are written straight away
+		in a single transaction.
+		"""
+		if self.database is not None:
+			self.database.save(self, all=not self.saved)
+		elif not self.saved or self.journal.error is not None:
+			blobs = set()
+			self.journal.snapshot(self.records(all=True, blobs=blobs), blobs)
+		else:
+			self.journal.append(self.records())
+
+		for name in self.stores:
+			getattr(self, name).clean()
+		self.saved = True
+		self.unsaved = 0
+
+	def flush(self):
+		"""\
+		Waits for everything which has been saved to be written to disk.
+		"""
+		if self.journal is not None:
+			self.journal.flush()
+
+	def changed(self, ids, cache, feature, early=True):
+		"""\
+		Works out which IDs need downloading and which no longer exist.
+
+		ids is an iterator of (id, modify time) pairs from the server and cache
+		is the ChangeDict they are stored in.
+
+		If the server supports feature the IDs arrive newest first, so once an
+		unchanged ID is found everything after it is unchanged too. As long as
+		the number of IDs on the server matches the number we have (plus the
+		new ones) nothing has been removed either and we can stop early.
+		Otherwise all the IDs are needed to find the removed ones.
+
+		early must be False when resuming an interrupted update. The checkpoints
+		saved the newest entries first, so older changed entries can come after
+		an unchanged one.
+
+		Returns (<ids to download>, <ids which were removed>).
+		"""
+		ordered = feature in self.features
+		total = getattr(ids, 'total', None)
+
+		if not ordered or total is None:
+			# Every ID is needed, so check them all at once
+			ids = list(ids)
+			removed = set(cache.keys()).difference([id for id, time in ids])
+			return cache.stale_ids(ids), list(removed)
+
+		get = cache.times.get
+
+		toget = []
+		seen = []
+		new = 0
+		for id, time in ids:
+			seen.append(id)
 
-		# Save each order now
-		for id in self.orders.keys():
-			for order in self.orders[id]:
-				f.write(str(order))
-				f.write(struct.pack('!Q', id))
+			current = get(id, None)
+			if current is None:
+				toget.append(id)
+				new += 1
+			elif time > current:
+				toget.append(id)
+			elif early and total == len(cache) + new:
+				return toget, []
 
-	def update(self, connection, callback):
+		return toget, list(set(cache.keys()).difference(seen))
+
+	def update(self, connection, callback, window=None, parallel=True):
 		"""\
 		Updates the cache using the connection.
 
+		window is the number of requests to keep in flight at once (defaults to
+		Pipeline.window).
+
+		If parallel is True the categories, designs, components, properties and
+		resources are downloaded at the same time rather than one after another.
+
 		The callback function is called in the following way,
 
 		callback(<message string>, group=<mode>)
@@ -326,6 +870,48 @@ class Cache(object):
 			properties
 			players
 			resources
+
+		Formatting a message for every object costs a lot of CPU with a large
+		universe. Wrap the callback in progress.Throttled to get at most one
+		message every Throttled.interval seconds while objects are arriving,
+		so only those messages are formatted.
+		"""
+		for pipeline in self.iupdate(connection, callback, window, parallel):
+			pipeline.wait()
+
+	def iprogress(self, connection, window=None, parallel=True):
+		"""\
+		Updates the cache using the connection, see update.
+
+		This is a generator which yields a progress.Progress record for each
+		step of the update (rather than calling a callback with a message) and
+		a Pipeline each time it needs to wait for data to arrive on the
+		connection. For example,
+
+		for step in cache.iprogress(connection):
+			if isinstance(step, progress.Progress):
+				print step.phase, step.done, step.total
+			else:
+				step.wait()
+		"""
+		steps = deque()
+		for waiting in self.iupdate(connection, progress.Reporter(steps.append), window, parallel):
+			while len(steps) > 0:
+				yield steps.popleft()
+			yield waiting
+
+		while len(steps) > 0:
+			yield steps.popleft()
+
+	def iupdate(self, connection, callback, window=None, parallel=True):
+		"""\
+		Updates the cache using the connection, see update.
+
+		This is a generator which yields a Pipeline each time it needs to wait
+		for data to arrive on the connection, so the update can be run from an
+		event loop. (Getting the lists of IDs still blocks.)
+
+		callback can also be a progress.Reporter.
 		"""
 
 		# FIXME: We should restart with an empty cache if the following has happened
@@ -334,246 +920,295 @@ class Cache(object):
 		#	FIXME: Should check that none of the Order definitions have changed
 
 
-		# Get the features this server support
-		callback("Looking for supported features...", mode="connecting")
-		self.features = connection.features()
+		report = progress.reporter(callback)
+
+		# Entries saved before an update was interrupted are newer than ones
+		# which were not downloaded yet, so the ID lists can't be cut short
+		early = self.phase is None
+		if not early:
+			report(progress.RESUME, self.phase)
 
-		# Get all the objects
+		# Get the features this server support
+		report(progress.START, "features", group="connecting")
+		features = connection.features()
+		if failed(features):
+			raise IOError("Failed to get the features the server supports..")
+		self.features = features
+		self.checkpoint("objects")
+
+		# Get all the objects and boards
 		# -----------------------------------------------------------------------------------
-		callback("Getting objects...", mode="objects")
+		# The objects, orders, boards and messages are all downloaded through
+		# the one pipeline so there is always a window of requests in flight.
+		pipeline = Pipeline(connection, window)
+
+		report(progress.START, "objects", group="objects")
 
 		# Figure out the IDs to download
-		toget = []
-		ids = []
-		for id, time in connection.get_object_ids(iter=True):
-			ids.append(id)
-			if not self.objects.has_key(id) or time > self.objects.times[id]:
-				toget.append(id)
-# FIXME: This doesn't work if an object disappears...
-#			elif constants.FEATURE_ORDERED_OBJECT in self.features:
-#				break
+		toget, removedobjects = self.changed(connection.get_object_ids(iter=True), 
+					self.objects, constants.FEATURE_ORDERED_OBJECT, early)
 
 		# Callback function
-		def OnPacket(p, callback=callback):
+		def OnPacket(p, report=report):
 			if not failed(p):
-				callback("Got object with ID of %i (last modified at %s)..." % (p.id, df(p.modify_time)), add=1)
+				report(progress.GOT, "objects", p.id, p.modify_time)
 			else:
-				callback("Get object failed...", add=1)
-
-		# Download the objects
-		callback("Have %i objects to get..." % len(toget), of=len(toget))
-		frames = connection.get_objects(ids=toget, callback=OnPacket)
-		callback("Gotten all objects...")
-
-		# Set the blocking so we can pipeline the order requests
-		connection.setblocking(True)
-		if failed(frames):
-			raise IOError("Failed to get objects..")
-
-		for id, object in zip(toget, frames):
-			# Did we download the object okay?
-			if failed(object):
-				# Clean up the object
-				if self.objects.has_key(id):
-					del self.objects[id]
-
-					if self.orders.has_key(id):
-						del self.orders[id]
-				continue
-
-			self.objects[id] = (object.modify_time, object)
-
-			# Pipeline the get order requests
-			self.orders[id] = (object.modify_time, [])
-			connection.get_orders(id, range(0, object.order_number))
-
-		# Wait for the response to the order requests
-		while len(toget) > 0:
-			result = None
-			while result is None:
-				result = connection.poll()
-
-			id = toget.pop(0)
-			#print id, repr(result)
+				report(progress.FAILED, "objects")
 
+		def OnOrders(result, object, self=self):
 			if failed(result):
-				continue
+				# Keep the old object so it is downloaded again next time
+				return
+			self.objects[object.id] = (object.modify_time, object)
+			self.orders[object.id]  = (object.modify_time, result)
+			self.checkpoint()
 
-			self.orders[id] = (self.objects[id].modify_time, result)
+		def OnObjects(frames, ids, self=self, pipeline=pipeline):
+			if failed(frames):
+				raise IOError("Failed to get objects..")
 
-		# Check for objects which no longer exist..
-		# FIXME: There should be a better way to do this
-		if len(ids) != len(self.objects):
-			gotten = set(ids)
-			having = set(self.objects.keys())
+			for id, object in zip(ids, frames):
+				# Did we download the object okay?
+				if failed(object):
+					# Clean up the object
+					if self.objects.has_key(id):
+						del self.objects[id]
 
-			difference = having.difference(gotten)
-			#print "diff", difference
-			for id in difference:
-				del self.objects[id]
-				if self.orders.has_key(id):
-					del self.orders[id]
+						if self.orders.has_key(id):
+							del self.orders[id]
+					continue
 
-		connection.setblocking(False)
+				# The object is only stored once its orders have arrived, so an
+				# interrupted update never leaves an object without its orders.
+				if object.order_number > 0:
+					# Pipeline the get order requests
+					pipeline.submit(lambda result, object=object: OnOrders(result, object),
+						connection.get_orders, id, range(0, object.order_number))
+				else:
+					OnOrders([], object)
 
-		#print "Building two way Universe Tree for speed"
-		def build(object, parent=None, self=self):
-			if parent:
-				object.parent = parent.id
-			for id in object.contains:
-				build(self.objects[id], object)
-		build(self.objects[0])
+		# Queue the object downloads
+		report(progress.TOTAL, "objects", total=len(toget))
+		for ids in chunks(toget, self.chunk):
+			pipeline.submit(lambda frames, ids=ids: OnObjects(frames, ids),
+				connection.get_objects, ids=ids, callback=OnPacket)
 
 		# Get all the boards 
 		# -----------------------------------------------------------------------------------
-		callback("Getting boards...", mode="boards")
+		report(progress.START, "boards", group="boards")
 
 		# Figure out the IDs to download
-		toget = []
-		ids = []
-		for id, time in connection.get_board_ids(iter=True):
-			ids.append(id)
-			if not self.boards.has_key(id) or time > self.boards.times[id]:
-				toget.append(id)
-# FIXME: This doesn't work if an object disappears...
-#			elif constants.FEATURE_ORDERED_BOARD in self.features:
-#				break
+		toget, removedboards = self.changed(connection.get_board_ids(iter=True), 
+					self.boards, constants.FEATURE_ORDERED_BOARD, early)
 
 		# Callback function
-		def OnPacket(p, callback=callback):
+		def OnPacket(p, report=report):
 			if not failed(p):
-				callback("Got board with ID of %i (last modified at %s)..." % (p.id, df(p.modify_time)), add=1)
+				report(progress.GOT, "boards", p.id, p.modify_time)
 			else:
-				callback("Get board failed...", add=1)
-
-		# Download the boards
-		callback("Have %i boards to get..." % len(toget), of=len(toget))
-		frames = []
-		if len(toget) > 0:
-			frames = connection.get_boards(ids=toget, callback=OnPacket)
-		callback("Gotten all boards...")
-
-		# Set the blocking so we can pipeline the order requests
-		connection.setblocking(True)
-
-		for id, board in zip(toget, frames):
-			# Did we download the board okay?
-			if failed(board):
-				# Clean up the board
-				if self.boards.has_key(id):
-					del self.boards[id]
-
-					if self.messages.has_key(id):
-						del self.messages[id]
-				continue
-
-			self.boards[id] = (time, board)
-
-			# Pipeline the get order requests
-			self.messages[id] = (time, [])
-			connection.get_messages(id, range(0, board.number))
-
-		while len(toget) > 0:
-			result = None
-			while result is None:
-				result = connection.poll()
-
-			id = toget.pop(0)
-			#print id, repr(result)
+				report(progress.FAILED, "boards")
 
+		def OnMessages(result, board, self=self):
 			if failed(result):
-				continue
-
-			self.messages[id] = (self.boards[id].modify_time, result)
-
-		connection.setblocking(False)
-
-		# Check for boards which no longer exist..
-		# FIXME: There should be a better way to do this
-		if len(ids) != len(self.boards):
-			gotten = set(ids)
-			having = set(self.boards.keys())
+				# Keep the old board so it is downloaded again next time
+				return
+			self.boards[board.id]   = (board.modify_time, board)
+			self.messages[board.id] = (board.modify_time, result)
+			self.checkpoint()
+
+		def OnBoards(frames, ids, self=self, pipeline=pipeline):
+			if failed(frames):
+				raise IOError("Failed to get boards..")
+
+			for id, board in zip(ids, frames):
+				# Did we download the board okay?
+				if failed(board):
+					# Clean up the board
+					if self.boards.has_key(id):
+						del self.boards[id]
+
+						if self.messages.has_key(id):
+							del self.messages[id]
+					continue
 
-			difference = having.difference(gotten)
-			for id in difference:
-				del self.boards[id]
-				if self.messages.has_key(id):
-					del self.messages[id]
+				# Like objects, boards are only stored with their messages
+				if board.number > 0:
+					# Pipeline the get message requests
+					pipeline.submit(lambda result, board=board: OnMessages(result, board),
+						connection.get_messages, id, range(0, board.number))
+				else:
+					OnMessages([], board)
+
+		# Queue the board downloads
+		report(progress.TOTAL, "boards", total=len(toget))
+		for ids in chunks(toget, self.chunk):
+			pipeline.submit(lambda frames, ids=ids: OnBoards(frames, ids),
+				connection.get_boards, ids=ids, callback=OnPacket)
+
+		# Download everything
+		for waiting in pipeline.run():
+			yield waiting
+		report(progress.FINISHED, "objects and boards")
+
+		# Remove objects which no longer exist..
+		for id in removedobjects:
+			del self.objects[id]
+			if self.orders.has_key(id):
+				del self.orders[id]
+
+		# Set the parent of the objects which moved
+		self.stamp()
+		self.checkpoint("boards")
+
+		# Remove boards which no longer exist..
+		for id in removedboards:
+			del self.boards[id]
+			if self.messages.has_key(id):
+				del self.messages[id]
+		self.checkpoint("order_descs")
 
 		# Get all the order descriptions
 		# -----------------------------------------------------------------------------------
-		callback("Getting order descriptions...", mode="order_descs")
+		report(progress.START, "order descriptions", group="order_descs")
 		iter = connection.get_orderdesc_ids(iter=True)
+		report(progress.TOTAL, "order descriptions", total=iter.total)
 
 		for id, time in iter:
-			callback("Getting order description with id of %i (last modified at %s)..." % (id, df(time)), of=iter.total)
+			# Already registered by an earlier update
+			if self.descriptions.get(id, None) == time:
+				report(progress.SKIPPED, "order descriptions", id, time)
+				continue
+
+			report(progress.GETTING, "order descriptions", id, time)
 
 			desc = connection.get_orderdescs(id=id)[0]
 
 			# Did we download the order description okay?
 			if not failed(desc):
 				desc.register()
+				self.descriptions[id] = time
 			else:
 				print "Warning: failed to get %i" % id, desc
 
-			callback("Got order description with id of %i (last modified at %s)..." % (id, df(time)), add=1)
+			report(progress.GOT, "order descriptions", id, time)
 
-		def get_all(name, get_ids, get, cache, feature, callback=callback):
-			callback("Getting %s..." % name)
+		self.checkpoint("designs")
+
+		# The categories, designs, components, properties and resources are
+		# independent so (if parallel) they are all downloaded through the one
+		# pipeline, otherwise each is downloaded in turn.
+		pipeline = Pipeline(connection, window)
+
+		def get_all(name, get_ids, get, cache, feature, report=report, pipeline=pipeline):
+			report(progress.START, name)
 
 			# Figure out the IDs to download
-			toget = []
-			for id, time in get_ids(iter=True):
-				if not cache.has_key(id) or time > cache.times[id]:
-					toget.append(id)
-				elif feature in self.features:
-					break
+			toget, removed = self.changed(get_ids(iter=True), cache, feature, early)
+			for id in removed:
+				del cache[id]
 
 			# If there is nothing left to do
 			if len(toget) == 0:
 				return
 
 			# Callback function
-			def OnPacket(p, callback=callback):
+			def OnPacket(p, report=report):
 				if not failed(p):
-					callback("Got %s with ID of %i (last modified at %s)..." % (name, p.id, df(p.modify_time)), add=1)
+					report(progress.GOT, name, p.id, p.modify_time)
 				else:
-					callback("Getting %s failed..." % name, add=1)
+					report(progress.FAILED, name)
 
-			# Download the objects
-			callback("Have %i %s to get..." % (len(toget), name), of=len(toget))
-			frames = get(ids=toget, callback=OnPacket)
-			callback("Gotten all %s..." % name)
+			def OnFrames(frames, ids, cache=cache):
+				if failed(frames):
+					raise IOError("Failed to get %s.." % name)
 
-			for id, object in zip(toget, frames):
-				# Did we download the object okay?
-				if failed(object):
-					# Clean up the object
-					if cache.has_key(id):
-						del cache[id]
-					continue
+				got = []
+				for id, object in zip(ids, frames):
+					# Did we download the object okay?
+					if failed(object):
+						# Clean up the object
+						if cache.has_key(id):
+							del cache[id]
+						continue
 
-				cache[id] = (time, object)
+					got.append((id, object.modify_time, object))
+				cache.update_many(got)
 
-		callback("Getting design objects...", mode="designs")
-		get_all("Categories", connection.get_category_ids, connection.get_categories, 
-					self.categories, constants.FEATURE_ORDERED_CATEGORY)
-
-		get_all("Designs", connection.get_design_ids, connection.get_designs, 
-					self.designs, constants.FEATURE_ORDERED_DESIGN)
-
-		get_all("Components", connection.get_component_ids, connection.get_components, 
-					self.components, constants.FEATURE_ORDERED_COMPONENT)
-
-		get_all("Properties", connection.get_property_ids, connection.get_properties, 
-					self.properties, constants.FEATURE_ORDERED_PROPERTY)
-
-		callback("Getting all other objects...", mode="remaining")
-		get_all("Resources", connection.get_resource_ids, connection.get_resources, 
-					self.resources, constants.FEATURE_ORDERED_RESOURCE)
+			# Download the objects
+			report(progress.TOTAL, name, total=len(toget))
+			for ids in chunks(toget, self.chunk):
+				pipeline.submit(lambda frames, ids=ids: OnFrames(frames, ids),
+					get, ids=ids, callback=OnPacket)
+
+		categories = (
+			("designs",   "design objects",
+				"Categories", connection.get_category_ids, connection.get_categories, 
+					self.categories, constants.FEATURE_ORDERED_CATEGORY),
+			(None,        None,
+				"Designs", connection.get_design_ids, connection.get_designs, 
+					self.designs, constants.FEATURE_ORDERED_DESIGN),
+			(None,        None,
+				"Components", connection.get_component_ids, connection.get_components, 
+					self.components, constants.FEATURE_ORDERED_COMPONENT),
+			(None,        None,
+				"Properties", connection.get_property_ids, connection.get_properties, 
+					self.properties, constants.FEATURE_ORDERED_PROPERTY),
+			("remaining", "all other objects",
+				"Resources", connection.get_resource_ids, connection.get_resources, 
+					self.resources, constants.FEATURE_ORDERED_RESOURCE),
+		)
+		for mode, group, name, get_ids, get, cache, feature in categories:
+			if mode is not None:
+				report(progress.START, group, group=mode)
+
+			get_all(name, get_ids, get, cache, feature)
+
+			if not parallel:
+				for waiting in pipeline.run():
+					yield waiting
+				report(progress.FINISHED, name)
+
+		if parallel:
+			for waiting in pipeline.run():
+				yield waiting
+			report(progress.FINISHED, "design and other objects")
+		self.checkpoint("players")
 
 		#get_all("Players", connection.get_player_ids, connection.get_players, 
 		#			self.players, constants.FEATURE_ORDERED_PLAYERS)
 		self.players[0] = connection.get_players(0)[0]
 		#print self.players
-		return
+
+		# The update finished
+		self.checkpoint(None)
+
+if __name__ == "__main__":
+	# Compare the time taken to download the designs and remaining objects
+	# sequentially and in parallel. (In parallel the downloads only finish
+	# at the end of the update, so only the time they take altogether can be
+	# compared.)
+	#	python cache.py <host> <username> <password>
+	import sys
+	import time
+	import tempfile
+
+	host, username, password = sys.argv[1:4]
+	for parallel in (False, True):
+		connection = Connection()
+		connection.setup(host=host)
+		if failed(connection.connect("libtpclient-py/benchmark")) or failed(connection.login(username, password)):
+			sys.exit("Unable to connect to %s" % host)
+
+		started = {}
+		def callback(message, mode=None, **kw):
+			if mode is not None:
+				started[mode] = time.time()
+
+		cache = Cache(Cache.key(host, username), configdir=tempfile.mkdtemp(), new=True)
+		start = time.time()
+		cache.update(connection, callback, parallel=parallel)
+		finished = time.time()
+		cache.flush()
+
+		print "parallel=%-5s designs onwards %.3fs update %.3fs" % (parallel,
+			finished-started['designs'], finished-start)
@@ -0,0 +1,204 @@
+"""\
+An SQLite database which can store the Cache instead of the journal (see the
+backend argument of Cache).
+
+Each entry of each of the Cache's dictionaries is a row. Loading only reads
+the IDs and modify times, a value is read from the database the first time it
+is used, and saving only writes the rows which have changed. As the database
+is updated a transaction at a time, it can be read (and queried by ID or
+modify time) by other programs while the client is using it.
+
+The values are stored the same way as in the journal (see journal.encode).
+"""
+
+# Python imports
+import os
+import marshal
+import threading
+
+try:
+	import sqlite3
+except ImportError:
+	sqlite3 = None
+
+if sqlite3 is not None:
+	Error = sqlite3.Error
+else:
+	class Error(Exception):
+		pass
+
+# Local imports
+import journal
+
+schema = (
+	"CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value)",
+	"CREATE TABLE IF NOT EXISTS entries (store TEXT NOT NULL, id INTEGER NOT NULL, time REAL NOT NULL, payload BLOB NOT NULL, PRIMARY KEY (store, id))",
+	"CREATE INDEX IF NOT EXISTS entries_time ON entries (store, time)",
+	"CREATE TABLE IF NOT EXISTS attributes (name TEXT PRIMARY KEY, payload BLOB NOT NULL)",
+	"CREATE TABLE IF NOT EXISTS descriptions (id INTEGER PRIMARY KEY, payload BLOB NOT NULL)",
+)
+
+class Database(object):
+	"""\
+	The database a Cache is stored in.
+
+	compound is the names of the dictionaries which store lists of frames.
+	"""
+	# Seconds to wait for another program to finish writing
+	timeout = 30
+
+	def __init__(self, file, version, compound=()):
+		if sqlite3 is None:
+			raise ImportError("Storing the cache in a database needs the sqlite3 module.")
+
+		self.file     = file
+		self.version  = version
+		self.compound = compound
+
+		# Values are read from the database by whichever thread uses them
+		self.lock       = threading.RLock()
+		self.connection = None
+
+	def connect(self):
+		"""\
+		Returns the connection to the database, creating the tables if needed.
+		"""
+		if self.connection is None:
+			c = sqlite3.connect(self.file, timeout=self.timeout, check_same_thread=False)
+			c.text_factory = str
+			# Lets other programs read while the database is being written
+			c.execute("PRAGMA journal_mode=WAL")
+			for statement in schema:
+				c.execute(statement)
+			c.commit()
+			self.connection = c
+		return self.connection
+
+	def close(self):
+		self.lock.acquire()
+		try:
+			if self.connection is not None:
+				self.connection.close()
+				self.connection = None
+		finally:
+			self.lock.release()
+
+	def exists(self):
+		return os.path.exists(self.file)
+
+	def query(self, sql, *args):
+		"""\
+		Returns all the rows a query finds.
+		"""
+		self.lock.acquire()
+		try:
+			return self.connect().execute(sql, args).fetchall()
+		finally:
+			self.lock.release()
+
+	def fileversion(self):
+		"""\
+		Returns the version of the cache in the database.
+		"""
+		rows = self.query("SELECT value FROM meta WHERE name = 'version'")
+		if len(rows) == 0:
+			raise IOError("The cache is missing the version!")
+		return rows[0][0]
+
+	def get(self, name, id):
+		"""\
+		Returns the value of an entry of one of the Cache's dictionaries.
+		"""
+		rows = self.query("SELECT payload FROM entries WHERE store = ? AND id = ?", name, id)
+		if len(rows) == 0:
+			raise KeyError(id)
+		return journal.decode(name in self.compound, str(rows[0][0]))
+
+	def modified(self, name, since):
+		"""\
+		Returns (id, time) of the entries of one of the Cache's dictionaries
+		which were modified after the given time.
+		"""
+		return self.query("SELECT id, time FROM entries WHERE store = ? AND time > ?", name, since)
+
+	def decoder(self, name):
+		"""\
+		Returns the function a LazyChangeDict uses to read its values.
+		"""
+		def decode(id, self=self, name=name):
+			return self.get(name, id)
+		return decode
+
+	def load(self, cache):
+		"""\
+		Loads the attributes and the IDs and modify times of the entries.
+		"""
+		version = self.fileversion()
+		if version != self.version:
+			raise IOError("The cache is not of this version! (It's version %s)" % (version,))
+
+		for id, payload in self.query("SELECT id, payload FROM descriptions"):
+			for desc in journal.frames(str(payload)):
+				desc.register()
+			cache.written[(journal.DESCRIPTION, "", id)] = str(payload)
+
+		for name, payload in self.query("SELECT name, payload FROM attributes"):
+			if name in cache.attributes:
+				setattr(cache, name, marshal.loads(str(payload)))
+				cache.written[(journal.ATTRIBUTE, name, 0)] = str(payload)
+
+		for name in cache.stores:
+			d = getattr(cache, name)
+			for id, time in self.query("SELECT id, time FROM entries WHERE store = ?", name):
+				d.defer(id, time)
+
+	def save(self, cache, all=False):
+		"""\
+		Writes the entries which have changed since the last save (or every
+		entry if all is True) in a single transaction.
+		"""
+		self.lock.acquire()
+		try:
+			c = self.connect()
+			try:
+				c.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('version', ?)", (self.version,))
+
+				for kind, what, id, payload in cache.extras(all):
+					if kind == journal.DESCRIPTION:
+						c.execute("INSERT OR REPLACE INTO descriptions (id, payload) VALUES (?, ?)",
+							(id, buffer(payload)))
+					else:
+						c.execute("INSERT OR REPLACE INTO attributes (name, payload) VALUES (?, ?)",
+							(what, buffer(payload)))
+
+				for name in cache.stores:
+					d = getattr(cache, name)
+					compound = name in self.compound
+
+					if all:
+						rows = [(name, id, d.times[id], buffer(journal.encode(compound, value))) for id, value in d.items()]
+						c.execute("DELETE FROM entries WHERE store = ?", (name,))
+						c.executemany("INSERT INTO entries (store, id, time, payload) VALUES (?, ?, ?, ?)", rows)
+						continue
+
+					# Values which were never read are already in the database
+					pending = getattr(d, 'pending', {})
+
+					rows = []
+					removed = []
+					for id in d.dirty:
+						if pending.has_key(id):
+							continue
+						if d.has_key(id):
+							rows.append((name, id, d.times[id], buffer(journal.encode(compound, d[id]))))
+						else:
+							removed.append((name, id))
+					c.executemany("INSERT OR REPLACE INTO entries (store, id, time, payload) VALUES (?, ?, ?, ?)", rows)
+					c.executemany("DELETE FROM entries WHERE store = ? AND id = ?", removed)
+
+				c.commit()
+			except:
+				c.rollback()
+				raise
+		finally:
+			self.lock.release()
@@ -0,0 +1,89 @@
+"""\
+Secondary indexes over the Cache's dictionaries.
+
+An index watches one of the cache's dictionaries so finding (for example) the
+objects owned by a player only has to look at the matching objects rather
+than every object in the universe. Indexes are built the first time they are
+used and are then kept up to date as the cache changes.
+"""
+
+# Local imports
+from ChangeDict import missing
+from Log import Watcher
+
+def attribute(name):
+	"""\
+	Returns a function which gets an attribute of a value (or None if it
+	doesn't have it).
+	"""
+	def get(value, name=name):
+		return getattr(value, name, None)
+	return get
+
+class Index(Watcher):
+	"""\
+	Finds the keys of the entries in one of the Cache's dictionaries by
+	function(value).
+
+	Entries for which function returns None are left out.
+	"""
+	def __init__(self, cache, store, function):
+		self.cache    = cache
+		self.stores   = (store,)
+		self.function = function
+
+		self.built    = False
+		# function(value) -> set of keys
+		self.keys     = {}
+		# key -> function(value)
+		self.values   = {}
+
+		self.watchers = {}
+		self.attach()
+
+	def build(self):
+		"""\
+		Indexes every entry.
+		"""
+		self.keys   = {}
+		self.values = {}
+		for key, value in getattr(self.cache, self.stores[0]).iteritems():
+			self.add(key, value)
+		self.built = True
+
+	def add(self, key, value):
+		indexed = self.function(value)
+		if indexed is None:
+			return
+
+		self.values[key] = indexed
+		self.keys.setdefault(indexed, set()).add(key)
+
+	def remove(self, key):
+		if not self.values.has_key(key):
+			return
+
+		indexed = self.values.pop(key)
+		keys = self.keys[indexed]
+		keys.discard(key)
+		if len(keys) == 0:
+			del self.keys[indexed]
+
+	def record(self, d, name, key, oldtime, old):
+		if not self.built:
+			return
+
+		self.remove(key)
+
+		value = d.get(key, missing)
+		if not value is missing:
+			self.add(key, value)
+
+	def __getitem__(self, indexed):
+		"""\
+		Returns a list of the keys of the entries where function(value) is
+		indexed.
+		"""
+		if not self.built:
+			self.build()
+		return list(self.keys.get(indexed, []))
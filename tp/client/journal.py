@@ -0,0 +1,910 @@
+"""\
+Journaled on-disk storage for the Cache.
+
+The cache is stored as a snapshot file and a journal file. Both are a stream
+of records, each of which sets (or removes) one entry of one of the Cache's
+dictionaries. Saving only appends records for the entries which changed since
+the last save to the journal. When the journal grows too large it is compacted
+back into a new snapshot in a background thread.
+
+Records are made on the thread which saves, but they are written to disk by a
+background writer thread, so saving never waits for the disk. Saves which
+are waiting to be written are merged together. Files are only replaced by
+renaming a complete (and synced) new file over the top of them, so a crash
+part way through a save never loses the cache.
+
+Payloads are content addressed, each distinct payload is stored once as a blob
+record and the entries which have it refer to it by its hash. The IDs (and
+sequence numbers) are taken out of a value before it is hashed, so values
+which only differ by their ID (such as empty planets or default orders) share
+one blob.
+
+Values are stored as the frames they were sent by the server in, so a cache
+survives the library's classes changing and loading never unpickles anything
+(see migrate for reading caches saved by older versions).
+
+The records can be compressed (with any of the codecs which are available).
+They are then written as a series of members, each compressed on its own, so
+they can be written and read a piece at a time.
+"""
+
+# Python imports
+import os
+import copy
+import mmap
+import struct
+import threading
+from cStringIO import StringIO
+import zlib
+import bz2
+from hashlib import sha1
+
+try:
+	import lzma
+except ImportError:
+	try:
+		from backports import lzma
+	except ImportError:
+		lzma = None
+
+# Other library imports
+from tp.netlib.objects import Header
+
+# Record kinds
+SET			= 'S'
+DELETE		= 'D'
+ATTRIBUTE	= 'A'
+DESCRIPTION	= 'R'
+BLOB		= 'B'
+HASHED		= 'H'
+
+# kind, what, id, modify time, payload length
+record = struct.Struct('!c15sqdI')
+# The version number and codec at the start of the snapshot
+header = struct.Struct('!I8s')
+# The length of a compressed member
+member = struct.Struct('!I')
+# Kinds of write
+SNAPSHOT	= "snapshot"
+APPEND		= "append"
+
+# Size of the hash which blobs are stored under
+digestsize = 20
+# The parent ID which follows the frame of a single value
+parentid = struct.Struct('!q')
+
+def pack(kind, what, id, time, payload):
+	"""\
+	Returns a record as a string.
+	"""
+	return record.pack(kind, what, id, time, len(payload)) + payload
+
+def scan(buffer, offset=0, end=None):
+	"""\
+	Yields (kind, what, id, time, offset, length) for each record in the buffer.
+
+	If the buffer ends part way through a record, a tuple of (None, offset)
+	is yielded last with the offset of the incomplete record.
+	"""
+	if end is None:
+		end = len(buffer)
+	while offset < end:
+		if offset + record.size > end:
+			yield None, offset
+			return
+
+		kind, what, id, time, length = record.unpack_from(buffer, offset)
+		if offset + record.size + length > end:
+			yield None, offset
+			return
+
+		yield kind, what.rstrip('\0'), id, time, offset + record.size, length
+		offset += record.size + length
+
+def encode(compound, value):
+	"""\
+	Returns the payload for a value.
+
+	Compound values (lists of orders or messages) are stored as their frames.
+	Other values are stored as their frame followed by the ID of their parent
+	(-1 if they have none, only objects have a parent, see Cache.stamp).
+	"""
+	if compound:
+		return "".join([str(frame) for frame in value])
+
+	parent = getattr(value, 'parent', None)
+	if parent is None:
+		parent = -1
+	return str(value) + parentid.pack(parent)
+
+def frames(data):
+	"""\
+	Returns the frames found in a string.
+	"""
+	result = []
+	offset = 0
+	while offset < len(data):
+		p = Header.fromstr(data[offset:offset+Header.size])
+		offset += Header.size
+
+		p.__process__(data[offset:offset+p.length])
+		offset += p.length
+
+		result.append(p)
+	return result
+
+def decode(compound, data):
+	"""\
+	Returns the value stored in a payload.
+	"""
+	if compound:
+		return frames(data)
+
+	end = len(data)-parentid.size
+	value, = frames(data[:end])
+	parent, = parentid.unpack_from(data, end)
+	if parent != -1:
+		value.parent = parent
+	return value
+
+def strip(compound, value, id):
+	"""\
+	Returns (value, stripped) with the things which make otherwise identical
+	values different taken out.
+
+	The sequence numbers of frames are always zeroed. If the value (or each
+	frame of a compound value) has the ID it is stored under, the ID is
+	zeroed and stripped is True. The original value is not changed.
+	"""
+	if compound:
+		stripped = len(value) > 0
+		for frame in value:
+			if getattr(frame, 'id', None) != id:
+				stripped = False
+				break
+
+		result = []
+		for frame in value:
+			frame = copy.copy(frame)
+			if hasattr(frame, 'sequence'):
+				frame.sequence = 0
+			if stripped:
+				frame.id = 0
+			result.append(frame)
+		return result, stripped
+
+	stripped = getattr(value, 'id', None) == id
+	if stripped or hasattr(value, 'sequence'):
+		value = copy.copy(value)
+		if hasattr(value, 'sequence'):
+			value.sequence = 0
+		if stripped:
+			value.id = 0
+	return value, stripped
+
+def unstrip(compound, value, id):
+	"""\
+	Puts the ID back into a value which was stripped.
+	"""
+	if compound:
+		for frame in value:
+			frame.id = id
+	else:
+		value.id = id
+	return value
+
+def reference(digest, stripped):
+	"""\
+	Returns the payload of a record which refers to a blob.
+	"""
+	return digest + (stripped and '1' or '0')
+
+def dereference(payload):
+	"""\
+	Returns (digest, stripped) from the payload of a record which refers to a
+	blob.
+	"""
+	return payload[:digestsize], payload[digestsize:digestsize+1] == '1'
+
+# codec -> (function(level) returning a compressor, function returning a decompressor)
+codecs = {
+	"zlib": (lambda level: zlib.compressobj(level is None and 6 or level), zlib.decompressobj),
+	"bz2":  (lambda level: bz2.BZ2Compressor(level is None and 9 or level), bz2.BZ2Decompressor),
+}
+if lzma is not None:
+	codecs["lzma"] = (lambda level: lzma.LZMACompressor(preset=level), lzma.LZMADecompressor)
+
+class Writer(object):
+	"""\
+	Writes records to a file, compressed if a codec is given.
+
+	Compressed records are written as members of about blocksize bytes (before
+	compression), each is the compressed length followed by the data.
+	"""
+	blocksize = 1024*1024
+
+	def __init__(self, f, codec=None, level=None):
+		self.f          = f
+		self.codec      = codec
+		self.level      = level
+		self.compressor = None
+
+	def write(self, data):
+		if not self.codec:
+			self.f.write(data)
+			return
+
+		if self.compressor is None:
+			self.compressor = codecs[self.codec][0](self.level)
+			self.parts = []
+			self.size  = 0
+
+		self.parts.append(self.compressor.compress(data))
+		self.size += len(data)
+		if self.size >= self.blocksize:
+			self.finish()
+
+	def finish(self):
+		"""\
+		Writes out the current member.
+		"""
+		if self.compressor is None:
+			return
+
+		self.parts.append(self.compressor.flush())
+		data = "".join(self.parts)
+		self.f.write(member.pack(len(data)) + data)
+
+		self.compressor = None
+		self.parts = []
+	close = finish
+
+def stream(f, codec, end=None, readsize=64*1024):
+	"""\
+	Yields (kind, what, id, time, buffer, offset, length) for each record in
+	a file of compressed members (up to end if given), reading and
+	decompressing a member at a time.
+
+	If the file ends part way through a member (or a member is corrupt), a
+	tuple of (None, offset) is yielded last with the offset of the member.
+	"""
+	leftover = ""
+	position = f.tell()
+	while end is None or position < end:
+		prefix = f.read(member.size)
+		if len(prefix) == 0:
+			break
+		if len(prefix) < member.size:
+			yield None, position
+			return
+
+		size, = member.unpack(prefix)
+
+		decompressor = codecs[codec][1]()
+		parts = [leftover]
+		remaining = size
+		try:
+			while remaining > 0:
+				data = f.read(min(remaining, readsize))
+				if len(data) == 0:
+					yield None, position
+					return
+				remaining -= len(data)
+				parts.append(decompressor.decompress(data))
+			if hasattr(decompressor, 'flush'):
+				parts.append(decompressor.flush())
+		except (zlib.error, IOError, EOFError, ValueError), e:
+			yield None, position
+			return
+
+		buffer = "".join(parts)
+		leftover = ""
+		for r in scan(buffer):
+			if r[0] is None:
+				# The rest of the record is in the next member
+				leftover = buffer[r[1]:]
+				break
+
+			kind, what, id, time, offset, length = r
+			yield kind, what, id, time, buffer, offset, length
+
+		position += member.size + size
+
+	if len(leftover) > 0:
+		yield None, position
+
+def sync(f):
+	"""\
+	Makes sure everything written to a file is on the disk.
+	"""
+	f.flush()
+	os.fsync(f.fileno())
+
+def replace(src, dst):
+	"""\
+	Renames src over the top of dst.
+	"""
+	try:
+		os.rename(src, dst)
+	except OSError:
+		# Windows will not rename over an existing file
+		os.remove(dst)
+		os.rename(src, dst)
+
+	# Make sure the rename is on the disk too
+	try:
+		fd = os.open(os.path.dirname(os.path.abspath(dst)), os.O_RDONLY)
+	except OSError:
+		# Can't open directories on Windows
+		return
+	try:
+		try:
+			os.fsync(fd)
+		except OSError:
+			pass
+	finally:
+		os.close(fd)
+
+def readonly(file):
+	"""\
+	Returns a read only buffer of the file's contents.
+	"""
+	f = open(file, 'rb')
+	try:
+		if os.fstat(f.fileno()).st_size == 0:
+			return ""
+		return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	finally:
+		f.close()
+
+class Journal(object):
+	"""\
+	A snapshot file and the journal of records to be replayed on top of it.
+	"""
+	# Compact when the journal is bigger than this fraction of the snapshot..
+	compactratio = 0.5
+	# ..but not before it is at least this big
+	compactsize  = 1024*1024
+
+	def __init__(self, file, version, codec=None, level=None):
+		if codec and not codecs.has_key(codec):
+			raise ValueError("Unknown compression %s (can use %s)" % (codec, ", ".join(codecs.keys())))
+
+		self.file    = file
+		self.journal = file + ".journal"
+		self.version = version
+
+		# The compression used for new snapshots..
+		self.codec   = codec
+		self.level   = level
+		# ..and the compression of the files on disk
+		self.filecodec = codec
+
+		# Held while the files are written, never by the thread saving
+		self.lock       = threading.Lock()
+		self.compactor  = None
+		# The number of snapshots written
+		self.generation = 0
+
+		# The writes waiting for the writer thread, a list of [kind, records]
+		# (a snapshot's records are (records, blobs, number))
+		self.pending    = []
+		self.queue      = threading.Condition()
+		self.writer     = None
+		# The exception the last failed write raised
+		self.error      = None
+
+		# The hashes of the blobs which have been written (or are waiting to
+		# be) and the number of snapshots asked for
+		self.blobs      = set()
+		self.snapshots  = 0
+		self.blobslock  = threading.RLock()
+
+	def exists(self):
+		return os.path.exists(self.file)
+
+	def fileversion(self):
+		"""\
+		Returns the version of the cache on disk.
+		"""
+		f = open(self.file, 'rb')
+		try:
+			data = f.read(4)
+		finally:
+			f.close()
+		if len(data) < 4:
+			raise IOError("The cache is missing the version header!")
+		return struct.unpack('!I', data)[0]
+
+	def size(self, file):
+		try:
+			return os.path.getsize(file)
+		except OSError:
+			return 0
+
+	def load(self, end=None):
+		"""\
+		Yields (kind, what, id, time, buffer, offset, length) for every record
+		in the snapshot and then the journal (up to end if given).
+		"""
+		f = open(self.file, 'rb')
+		try:
+			data = f.read(header.size)
+		finally:
+			f.close()
+		if len(data) < header.size:
+			raise IOError("The cache is missing the version header!")
+
+		v, codec = header.unpack(data)
+		if v != self.version:
+			raise IOError("The cache is not of this version! (It's version %s)" % (v,))
+
+		codec = codec.rstrip('\0')
+		if codec and not codecs.has_key(codec):
+			raise IOError("The cache is compressed with %s which is not available!" % (codec,))
+		self.filecodec = codec
+
+		for r in self.read(self.file, header.size):
+			if r[0] is None:
+				raise IOError("Garbage was found at the end!")
+
+			if r[0] == BLOB:
+				kind, what, id, time, buffer, offset, length = r
+				self.blobs.add(buffer[offset:offset+digestsize])
+			yield r
+
+		if not os.path.exists(self.journal):
+			return
+
+		for r in self.read(self.journal, 0, end):
+			if r[0] is None:
+				# The last append never finished, throw away the partial record
+				print "Discarding incomplete record at the end of %s." % (self.journal,)
+				self.truncate(r[1])
+				break
+
+			if r[0] == BLOB:
+				kind, what, id, time, buffer, offset, length = r
+				self.blobs.add(buffer[offset:offset+digestsize])
+			yield r
+
+	def read(self, file, start, end=None):
+		"""\
+		Yields (kind, what, id, time, buffer, offset, length) for each record
+		in a file from start (up to end if given), or (None, offset) if the
+		file ends part way through a record.
+		"""
+		if not self.filecodec:
+			buffer = readonly(file)
+			for r in scan(buffer, start, end):
+				if r[0] is None:
+					yield r
+					return
+
+				kind, what, id, time, offset, length = r
+				yield kind, what, id, time, buffer, offset, length
+			return
+
+		f = open(file, 'rb')
+		try:
+			f.seek(start)
+			for r in stream(f, self.filecodec, end):
+				yield r
+		finally:
+			f.close()
+
+	def truncate(self, size):
+		self.lock.acquire()
+		try:
+			f = open(self.journal, 'r+b')
+			f.truncate(size)
+			f.close()
+		finally:
+			self.lock.release()
+
+	def hashed(self, what, id, time, data, stripped, blobs=None):
+		"""\
+		Returns the records which set an entry to the payload data.
+
+		The payload is only written as a blob if it isn't in blobs (the blobs
+		already written to the journal if not given) and is then added to it.
+		Must be used from the records given to snapshot or append.
+		"""
+		digest = sha1(data).digest()
+
+		result = pack(HASHED, what, id, time, reference(digest, stripped))
+		if blobs is None:
+			self.blobslock.acquire()
+			try:
+				written = digest in self.blobs
+				self.blobs.add(digest)
+			finally:
+				self.blobslock.release()
+		else:
+			written = digest in blobs
+			blobs.add(digest)
+
+		if not written:
+			result = pack(BLOB, "", 0, -1, digest + data) + result
+		return result
+
+	def snapshot(self, records, blobs):
+		"""\
+		Writes a completely new snapshot and throws away the journal.
+
+		The records are made as they are written by the writer thread, so
+		must not depend on anything the caller changes afterwards. They must
+		give hashed the (empty) set blobs, as appends made while the snapshot
+		is written don't know what it contains. Any appends still waiting to
+		be written are dropped.
+		"""
+		self.blobslock.acquire()
+		try:
+			# Appends made from now on come after the snapshot, so they need
+			# to write all their blobs
+			self.blobs = set()
+			self.snapshots += 1
+			number = self.snapshots
+		finally:
+			self.blobslock.release()
+
+		self.queue.acquire()
+		try:
+			# The snapshot replaces anything which failed to be written
+			self.error   = None
+			self.pending = [[SNAPSHOT, (records, blobs, number)]]
+			self.start()
+		finally:
+			self.queue.release()
+
+	def append(self, records):
+		"""\
+		Appends records to the journal.
+
+		The records are made straight away but written by the writer thread,
+		merged with any other appends still waiting to be written.
+
+		Nothing is appended after a write failed, as the records might refer to
+		blobs which were never written. The next save must be a snapshot.
+		"""
+		# (A compaction mustn't forget the blobs these records skip until they
+		# are waiting to be written)
+		self.blobslock.acquire()
+		try:
+			records = list(records)
+			if len(records) == 0:
+				return
+
+			self.queue.acquire()
+			try:
+				if self.error is not None:
+					return
+
+				if len(self.pending) > 0 and self.pending[-1][0] == APPEND:
+					self.pending[-1][1].extend(records)
+				else:
+					self.pending.append([APPEND, records])
+				self.start()
+			finally:
+				self.queue.release()
+		finally:
+			self.blobslock.release()
+
+	def start(self):
+		# Must be called with the queue held
+		if self.writer is not None:
+			return
+
+		# Not a daemon, so the program doesn't exit before the cache is saved
+		self.writer = threading.Thread(target=self._writer, name="Cache Writer")
+		self.writer.start()
+
+	def flush(self):
+		"""\
+		Waits for every save to be written.
+
+		Raises the exception of the last write if it failed, until a new
+		snapshot is saved. Also waits for any compaction to finish, so the
+		files can then be opened again.
+		"""
+		self.queue.acquire()
+		try:
+			while self.writer is not None:
+				self.queue.wait()
+			error = self.error
+		finally:
+			self.queue.release()
+
+		self.wait()
+
+		if error is not None:
+			raise error
+
+	def _writer(self):
+		while True:
+			self.lock.acquire()
+			try:
+				self.queue.acquire()
+				try:
+					if len(self.pending) == 0:
+						self.writer = None
+						self.queue.notifyAll()
+						return
+					kind, records = self.pending.pop(0)
+				finally:
+					self.queue.release()
+
+				if kind == APPEND:
+					try:
+						self._append(records)
+					except Exception, e:
+						self.failed(e)
+			finally:
+				self.lock.release()
+
+			if kind == SNAPSHOT:
+				try:
+					self._snapshot(*records)
+				except Exception, e:
+					self.failed(e)
+			elif self.needscompact():
+				self.compact()
+
+	def failed(self, error):
+		"""\
+		Remembers a write failed and drops the appends waiting to be written,
+		which might refer to blobs only the failed write had.
+		"""
+		self.queue.acquire()
+		try:
+			self.error   = error
+			self.pending = [p for p in self.pending if p[0] != APPEND]
+		finally:
+			self.queue.release()
+
+	def _snapshot(self, records, blobs, number):
+		self.wait()
+
+		self.lock.acquire()
+		try:
+			f = open(self.file + ".tmp", 'wb')
+			f.write(header.pack(self.version, self.codec or ""))
+			w = Writer(f, self.codec, self.level)
+			for r in records:
+				w.write(r)
+			w.close()
+			sync(f)
+			f.close()
+			self.filecodec = self.codec
+
+			replace(self.file + ".tmp", self.file)
+			if os.path.exists(self.journal):
+				os.remove(self.journal)
+			self.generation += 1
+
+			self.blobslock.acquire()
+			try:
+				# Unless another snapshot has been asked for since
+				if number == self.snapshots:
+					self.blobs.update(blobs)
+			finally:
+				self.blobslock.release()
+		finally:
+			self.lock.release()
+
+	def _append(self, records):
+		# Must be called with the lock held
+		f = open(self.journal, 'ab')
+		w = Writer(f, self.filecodec, self.level)
+		for r in records:
+			w.write(r)
+		w.close()
+		sync(f)
+		f.close()
+
+	def needscompact(self):
+		size = self.size(self.journal)
+		return size > self.compactsize and size > self.size(self.file) * self.compactratio
+
+	def wait(self):
+		"""\
+		Waits for any background compaction to finish.
+		"""
+		compactor = self.compactor
+		if compactor is not None:
+			compactor.join()
+
+	def compact(self, background=True):
+		"""\
+		Merges the journal into a new snapshot.
+
+		Only the last record for each entry is kept. The journal can still be
+		appended to while the compaction is running.
+		"""
+		if self.compactor is not None and self.compactor.isAlive():
+			return
+
+		if not background:
+			self._compact()
+			return
+
+		# Not a daemon, the files would be left half written
+		self.compactor = threading.Thread(target=self._compact, name="Cache Compactor")
+		self.compactor.start()
+
+	def _compact(self):
+		self.lock.acquire()
+		try:
+			generation = self.generation
+			end = self.size(self.journal)
+			filecodec = self.filecodec
+		finally:
+			self.lock.release()
+
+		# Only keep the last record for each entry
+		latest = {}
+		order = []
+		blobs = {}
+		for kind, what, id, time, buffer, offset, length in self.load(end):
+			if kind == BLOB:
+				blobs[buffer[offset:offset+digestsize]] = (kind, what, id, time, buffer, offset, length)
+				continue
+
+			key = (kind in (DELETE, HASHED) and SET or kind, what, id)
+			if not latest.has_key(key):
+				order.append(key)
+			latest[key] = (kind, what, id, time, buffer, offset, length)
+
+		# Only keep the blobs which are still used
+		used = {}
+		for key in order:
+			kind, what, id, time, buffer, offset, length = latest[key]
+			if kind == HASHED:
+				digest = dereference(buffer[offset:offset+length])[0]
+				if blobs.has_key(digest):
+					used[digest] = blobs[digest]
+
+		# Compressed the way new snapshots are, anything appended meanwhile is
+		# converted below
+		codec = self.codec
+
+		f = open(self.file + ".compact", 'wb')
+		f.write(header.pack(self.version, codec or ""))
+		w = Writer(f, codec, self.level)
+		# Descriptions must be registered before the orders which use them
+		# and blobs must be before the entries which refer to them
+		for r in used.values():
+			kind, what, id, time, buffer, offset, length = r
+			w.write(pack(kind, what, id, time, buffer[offset:offset+length]))
+		for first in (True, False):
+			for key in order:
+				kind, what, id, time, buffer, offset, length = latest[key]
+				if kind == DELETE or (kind == DESCRIPTION) != first:
+					continue
+				w.write(pack(kind, what, id, time, buffer[offset:offset+length]))
+		w.close()
+		sync(f)
+		f.close()
+
+		self.lock.acquire()
+		try:
+			if generation != self.generation:
+				# A new snapshot was written while we were working
+				os.remove(self.file + ".compact")
+				return
+			self.generation += 1
+
+			# Keep anything which was appended while we were compacting
+			f = open(self.journal, 'rb')
+			f.seek(end)
+			rest = f.read()
+			f.close()
+
+			# Which (like the appends still waiting to be written) might refer
+			# to blobs which were thrown away
+			kept = set(used.keys())
+			missing = []
+			if filecodec:
+				appended = list(stream(StringIO(rest), filecodec))
+			else:
+				appended = [r[:4] + (rest,) + r[4:] for r in scan(rest) if r[0] is not None]
+			converted = [r for r in appended if r[0] is not None]
+
+			# Appends being made wait until the blobs thrown away are forgotten,
+			# so they either are waiting here or write those blobs themselves
+			self.blobslock.acquire()
+			try:
+				self.queue.acquire()
+				try:
+					waiting = "".join([r for kind, records in self.pending if kind == APPEND for r in records])
+				finally:
+					self.queue.release()
+				appended += [r[:4] + (waiting,) + r[4:] for r in scan(waiting)]
+
+				for r in appended:
+					if r[0] is None:
+						continue
+					kind, what, id, time, buffer, offset, length = r
+					if kind == BLOB:
+						kept.add(buffer[offset:offset+digestsize])
+					elif kind == HASHED:
+						digest = dereference(buffer[offset:offset+length])[0]
+						if not digest in kept and blobs.has_key(digest):
+							kept.add(digest)
+							missing.append(blobs[digest])
+
+				self.blobs &= kept
+			finally:
+				self.blobslock.release()
+
+			f = open(self.journal + ".compact", 'wb')
+			w = Writer(f, codec, self.level)
+			for kind, what, id, time, buffer, offset, length in missing:
+				w.write(pack(kind, what, id, time, buffer[offset:offset+length]))
+			if codec != filecodec:
+				for kind, what, id, time, buffer, offset, length in converted:
+					w.write(pack(kind, what, id, time, buffer[offset:offset+length]))
+			w.close()
+			if codec == filecodec:
+				f.write(rest)
+			sync(f)
+			f.close()
+
+			replace(self.file + ".compact", self.file)
+			replace(self.journal + ".compact", self.journal)
+			self.filecodec = codec
+		finally:
+			self.lock.release()
+
+if __name__ == "__main__":
+	# Compare the size of a cache and the time to save and load it with each
+	# of the codecs and compression levels.
+	#	python journal.py
+	import time
+	import random
+	import shutil
+	import tempfile
+	import cPickle as pickle
+
+	# Something like a universe of planets and fleets (the payloads only need
+	# to compress like real ones)
+	class Thing(object):
+		pass
+
+	random.seed(0)
+	records = []
+	for id in xrange(20000):
+		thing = Thing()
+		thing.id = id
+		thing.name = random.choice(["Planet", "Fleet", "System"]) + " %i" % id
+		thing.pos = (random.randint(-10**9, 10**9), random.randint(-10**9, 10**9), 0)
+		thing.contains = range(random.randint(0, 5))
+		thing.owner = random.randint(-1, 10)
+		records.append(pack(SET, "objects", id, 1234567890+id, pickle.dumps(thing, 2)))
+
+	choices = [(None, None)]
+	for codec in ("zlib", "bz2", "lzma"):
+		if codecs.has_key(codec):
+			for level in (1, 6, 9):
+				choices.append((codec, level))
+
+	directory = tempfile.mkdtemp()
+	try:
+		for codec, level in choices:
+			j = Journal(os.path.join(directory, "bench.%s.%s" % (codec, level)), 0, codec, level)
+
+			start = time.time()
+			j.snapshot(records, set())
+			j.flush()
+			saved = time.time()-start
+
+			start = time.time()
+			number = 0
+			for r in j.load():
+				number += 1
+			loaded = time.time()-start
+
+			print "%-5s level %-4s %9i bytes, save %.3fs, load %.3fs (%i records)" % (
+				codec, level, j.size(j.file), saved, loaded, number)
+	finally:
+		shutil.rmtree(directory)
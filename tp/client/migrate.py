@@ -0,0 +1,93 @@
+"""\
+Reads caches saved by older versions of the library.
+
+Rather than throwing an old cache away (and downloading the whole universe
+again), its records are converted to the current format (see journal) as they
+are read. The Cache loads them like any other records and then writes a new
+snapshot, so an old cache is only converted once.
+
+The versions which can be read are,
+	3 - A pickle of the whole cache followed by the frames of the orders.
+
+Old caches are pickles, this is the only place the cache still unpickles
+anything.
+"""
+
+# Python imports
+import struct
+import marshal
+import cPickle as pickle
+
+# Other library imports
+from tp.netlib.objects import Header, Description
+
+# Local imports
+import journal
+
+def record(kind, what, id, time, payload):
+	"""\
+	Returns a record as the tuple journal.Journal.load yields.
+	"""
+	return kind, what, id, time, payload, 0, len(payload)
+
+def version3(cache):
+	"""\
+	Yields the records of a version 3 cache.
+	"""
+	f = open(cache.file, 'rb')
+	try:
+		f.read(4)
+		try:
+			state = pickle.load(f)
+		except (ImportError, AttributeError, pickle.UnpicklingError, EOFError, IndexError, KeyError, TypeError), e:
+			# Classes which have since been renamed or removed can't be loaded
+			raise IOError("Unable to unpickle the old cache! (%s)" % (e,))
+
+		for name in cache.attributes:
+			if state.has_key(name):
+				yield record(journal.ATTRIBUTE, name, 0, -1, marshal.dumps(state[name]))
+
+		for name in cache.stores:
+			if not state.has_key(name):
+				continue
+
+			d = state[name]
+			times = d.__dict__['times']
+			for id, value in dict.items(d):
+				yield record(journal.SET, name, id, times[id], journal.encode(name in cache.compound, value))
+
+		# The orders (and order descriptions) follow the pickle as frames
+		orders = {}
+		while True:
+			data = f.read(Header.size)
+			if len(data) != Header.size:
+				if len(data) != 0:
+					raise IOError("Garbage was found at the end!")
+				break
+
+			p = Header.fromstr(data)
+			p.__process__(f.read(p.length))
+
+			if isinstance(p, Description):
+				yield record(journal.DESCRIPTION, "", p.id, -1, str(p))
+			else:
+				id, = struct.unpack('!Q', f.read(8))
+				orders.setdefault(id, []).append(p)
+	finally:
+		f.close()
+
+	# Orders have the modify time of their object
+	times = {}
+	if state.has_key("objects"):
+		times = state["objects"].__dict__['times']
+	for id, frames in orders.iteritems():
+		time = times.get(id, -1)
+		yield record(journal.SET, "orders", id, time, journal.encode(True, frames))
+
+def records(cache, version):
+	"""\
+	Yields the records of an old version of the cache in the current format.
+	"""
+	if version == 3:
+		return version3(cache)
+	raise IOError("The cache is not of a version which can be read! (It's version %s)" % (version,))
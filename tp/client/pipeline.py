@@ -0,0 +1,107 @@
+"""\
+Pipelining of requests over a single Connection.
+
+Rather than waiting for the response to each request before sending the next,
+a window of requests is kept outstanding on the connection so that a large
+download is limited by bandwidth rather than the round trip time.
+"""
+
+# Python imports
+import select
+from collections import deque
+
+class Pipeline(object):
+	"""\
+	Keeps a window of requests outstanding on a connection.
+
+	Requests are queued with submit() and sent as soon as there is room in the
+	window. The handler for a request is called with the result when it
+	arrives, handlers can submit further requests.
+
+	The results always arrive in the order the requests were sent.
+	"""
+	# Default number of requests to have outstanding
+	window = 32
+
+	def __init__(self, connection, window=None):
+		self.connection = connection
+		if window is not None:
+			self.window = window
+
+		self.queued      = deque()
+		self.outstanding = deque()
+
+	def __len__(self):
+		return len(self.queued) + len(self.outstanding)
+
+	def submit(self, handler, method, *args, **kw):
+		"""\
+		Queues a request, handler(result) is called when it completes.
+		"""
+		self.queued.append((handler, method, args, kw))
+
+	def send(self):
+		"""\
+		Sends queued requests until the window is full.
+		"""
+		while len(self.queued) > 0 and len(self.outstanding) < self.window:
+			handler, method, args, kw = self.queued.popleft()
+
+			result = method(*args, **kw)
+			if result is None:
+				self.outstanding.append(handler)
+			else:
+				# The connection didn't pipeline this request
+				handler(result)
+
+	def poll(self):
+		"""\
+		Handles any results which have arrived without blocking.
+
+		Returns False if there was nothing to handle.
+		"""
+		progress = False
+		while len(self.outstanding) > 0:
+			result = self.connection.poll()
+			if result is None:
+				break
+
+			handler = self.outstanding.popleft()
+			handler(result)
+			progress = True
+
+		self.send()
+		return progress
+
+	def fileno(self):
+		return self.connection.s.fileno()
+
+	def wait(self, timeout=None):
+		"""\
+		Blocks until there is data waiting on the connection.
+		"""
+		select.select([self], [], [], timeout)
+
+	def run(self):
+		"""\
+		Sends every request and handles every result.
+
+		This is a generator which yields the pipeline each time it needs to
+		wait for data to arrive on the connection. The caller can then wait for
+		the pipeline to become readable (it can be passed to select).
+		"""
+		self.connection.setblocking(True)
+		try:
+			self.send()
+			while len(self.outstanding) > 0:
+				if not self.poll():
+					yield self
+		finally:
+			self.connection.setblocking(False)
+
+	def flush(self):
+		"""\
+		Blocks until every request has been handled.
+		"""
+		for pipeline in self.run():
+			pipeline.wait()
@@ -0,0 +1,293 @@
+"""\
+Structured progress reports for updating the Cache.
+
+While updating, the Cache reports each step as a Progress record rather than
+a message string. Records can be turned back into the messages the update
+callback has always been given by Messages, but nothing is formatted unless
+a message is actually wanted.
+
+Throttled goes further and only passes on (and formats) a message every so
+often while lots of objects are arriving.
+"""
+
+# Python imports
+import time
+from datetime import datetime
+
+def df(time):
+	if type(time) in (float, int, long):
+		return datetime.utcfromtimestamp(time).strftime('%c')
+	elif type(time) is datetime:
+		return time.strftime('%c')
+	else:
+		raise TypeError("Unable to output this type...")
+
+# Kinds of Progress
+RESUME		= "resume"		# An unfinished update is being resumed from phase
+START		= "start"		# Started getting phase
+TOTAL		= "total"		# The number of things to get for phase is known
+GETTING		= "getting"		# Started getting id
+GOT			= "got"			# Got id (last modified at time)
+FAILED		= "failed"		# Getting id failed
+SKIPPED		= "skipped"		# Already had id
+FINISHED	= "finished"	# Got everything for phase
+
+# Kinds which happen for every single thing got
+single = (GETTING, GOT, FAILED, SKIPPED)
+
+class Progress(object):
+	"""\
+	One step of an update.
+
+	kind	- What happened (one of the kinds above)
+	phase	- What is being got (objects, boards, Designs, etc)
+	done	- The number of things got so far for this phase
+	total	- The number of things to get for this phase (None if not known)
+	id		- The ID of the thing got (None if not about a single thing)
+	time	- The modify time of the thing got
+	group	- The group of the update this phase starts (None if it doesn't)
+	"""
+	__slots__ = ("kind", "phase", "done", "total", "id", "time", "group")
+
+	def __init__(self, kind, phase, done=0, total=None, id=None, time=None, group=None):
+		self.kind  = kind
+		self.phase = phase
+		self.done  = done
+		self.total = total
+		self.id    = id
+		self.time  = time
+		self.group = group
+
+	def __repr__(self):
+		return "<Progress %s %s %s/%s id=%s>" % (self.kind, self.phase, self.done, self.total, self.id)
+
+	# Messages for phases which don't follow the normal pattern
+	starts = {
+		"features": "Looking for supported features...",
+	}
+	# What a single thing of a phase is called
+	singular = {
+		"objects": "object",
+		"boards": "board",
+		"order descriptions": "order description",
+	}
+
+	def message(self):
+		"""\
+		Returns a human readable message about this step.
+		"""
+		phase = self.phase
+		thing = self.singular.get(phase, phase)
+
+		if self.kind == RESUME:
+			return "Resuming an update which stopped while getting %s..." % (phase,)
+		elif self.kind == START:
+			return self.starts.get(phase, "Getting %s..." % (phase,))
+		elif self.kind == TOTAL:
+			return "Have %i %s to get..." % (self.total, phase)
+		elif self.kind == GETTING:
+			return "Getting %s with id of %i (last modified at %s)..." % (thing, self.id, df(self.time))
+		elif self.kind == GOT:
+			return "Got %s with ID of %i (last modified at %s)..." % (thing, self.id, df(self.time))
+		elif self.kind == FAILED:
+			return "Getting %s failed..." % (thing,)
+		elif self.kind == SKIPPED:
+			return "Already have %s with id of %i..." % (thing, self.id)
+		elif self.kind == FINISHED:
+			return "Gotten all %s..." % (phase,)
+		return "%s %s..." % (self.kind, phase)
+
+	def arguments(self):
+		"""\
+		Returns the keyword arguments the update callback is given for this
+		step.
+		"""
+		if self.kind == START and self.group is not None:
+			return {'mode': self.group}
+		elif self.kind == TOTAL:
+			return {'of': self.total}
+		elif self.kind in (GOT, FAILED):
+			return {'add': 1}
+		elif self.kind == SKIPPED:
+			return {'of': self.total, 'add': 1}
+		elif self.kind == GETTING:
+			return {'of': self.total}
+		return {}
+
+class Reporter(object):
+	"""\
+	Turns the steps of an update into Progress records which are given to
+	sink.
+	"""
+	def __init__(self, sink):
+		self.sink   = sink
+		self.done   = {}
+		self.totals = {}
+
+	def __call__(self, kind, phase, id=None, time=None, total=None, group=None):
+		if kind == TOTAL:
+			self.totals[phase] = total
+		elif kind in (GOT, FAILED, SKIPPED):
+			self.done[phase] = self.done.get(phase, 0) + 1
+
+		self.sink(Progress(kind, phase, self.done.get(phase, 0), self.totals.get(phase, None), id, time, group))
+
+class Messages(object):
+	"""\
+	Gives each Progress record to an update callback in the old way,
+		callback(<message string>, <keyword arguments>)
+	"""
+	def __init__(self, callback):
+		self.callback = callback
+
+	def __call__(self, progress):
+		self.callback(progress.message(), **progress.arguments())
+
+class Throttled(Messages):
+	"""\
+	Gives Progress records to an update callback like Messages, but the steps
+	for single things (which happen for every object got) are only passed on
+	(and so formatted) once every interval seconds. add is then the number of
+	things got since the last one.
+	"""
+	interval = 0.1
+
+	def __init__(self, callback, interval=None):
+		Messages.__init__(self, callback)
+		if interval is not None:
+			self.interval = interval
+
+		self.last  = 0
+		self.held  = None
+		self.added = 0
+
+	def __call__(self, progress):
+		if progress.kind in single:
+			if progress.kind != GETTING:
+				self.added += 1
+			self.held = progress
+
+			now = time.time()
+			if now - self.last < self.interval:
+				return
+			self.last = now
+			self.flush()
+		else:
+			self.flush()
+			self.callback(progress.message(), **progress.arguments())
+
+	def flush(self):
+		"""\
+		Passes on the last step held back (if any).
+		"""
+		if self.held is None:
+			return
+		progress, self.held = self.held, None
+
+		kw = progress.arguments()
+		if self.added > 0:
+			kw['add'] = self.added
+		self.added = 0
+
+		self.callback(progress.message(), **kw)
+
+def reporter(callback):
+	"""\
+	Returns a Reporter for an update callback (which can already be a
+	Reporter or Messages).
+	"""
+	if isinstance(callback, Reporter):
+		return callback
+	if isinstance(callback, Messages):
+		return Reporter(callback)
+	return Reporter(Messages(callback))
+
+if __name__ == "__main__":
+	# Compare the CPU time taken to update a cache with lots of objects in each
+	# of the ways the update can be given a callback. (The cache isn't saved,
+	# so only the update itself is timed.)
+	#	python progress.py
+	import shutil
+	import tempfile
+	from tp.netlib import constants
+	from cache import Cache
+	# The classes the cache knows about, rather than the copies in __main__
+	from progress import Reporter, Messages, Throttled
+
+	class Thing(object):
+		def __init__(self, id, modify_time, contains=()):
+			self.id           = id
+			self.modify_time  = modify_time
+			self.contains     = list(contains)
+			self.order_number = 0
+
+	class IDs(list):
+		def __init__(self, things):
+			list.__init__(self, [(thing.id, thing.modify_time) for thing in things])
+			self.total = len(self)
+
+	class Server(object):
+		"""\
+		A server with lots of objects and nothing else.
+		"""
+		def __init__(self, number):
+			self.objects = [Thing(0, 1, range(1, number))]
+			for id in xrange(1, number):
+				self.objects.append(Thing(id, 1234567890+id))
+
+		def setblocking(self, blocking):
+			pass
+
+		def features(self):
+			return [constants.FEATURE_ORDERED_OBJECT]
+
+		def get_object_ids(self, iter=True):
+			return IDs(self.objects)
+
+		def get_objects(self, ids, callback=None):
+			return [self.objects[id] for id in ids]
+
+		def nothing(self, iter=True):
+			return IDs([])
+		get_board_ids = get_orderdesc_ids = get_category_ids = get_design_ids = nothing
+		get_component_ids = get_property_ids = get_resource_ids = nothing
+
+		def none(self, ids, callback=None):
+			return []
+		get_boards = get_categories = get_designs = get_components = get_properties = get_resources = none
+
+		def get_players(self, id):
+			return [Thing(id, 0)]
+
+	def consumer(message, **kw):
+		# Like a progress dialog which shows every message
+		str(message)
+
+	def ignorer(message, **kw):
+		# Like a client which only looks at the counts
+		pass
+
+	def nothing(progress):
+		pass
+
+	ways = (
+		("progress records (none used)",   lambda: Reporter(nothing)),
+		("messages (every message used)",  lambda: Messages(consumer)),
+		("messages (no message used)",     lambda: Messages(ignorer)),
+		("throttled (every message used)", lambda: Throttled(consumer)),
+		("throttled (no message used)",    lambda: Throttled(ignorer)),
+	)
+
+	number = 20000
+	server = Server(number)
+	for name, make in ways:
+		configdir = tempfile.mkdtemp()
+		cache = Cache("tp://benchmark@localhost:6923/", configdir=configdir, new=True)
+		cache.save = lambda: None
+
+		start = time.clock()
+		cache.update(server, make())
+		taken = time.clock()-start
+
+		shutil.rmtree(configdir)
+		print "%-32s %.3fs CPU to update %i objects (%.2fus each)" % (name, taken, number, taken/number*1e6)
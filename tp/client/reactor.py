@@ -0,0 +1,456 @@
+"""\
+A single threaded alternative to Application for running lots of sessions.
+
+An Application uses three threads for each game it is connected to. Headless
+clients (such as AIs) which play many games at once can instead create a
+Session for each game and run them all on one Reactor in a single thread.
+
+Everything a session does is a coroutine - a generator which yields when it
+needs to wait,
+	yield <object with a fileno method>	- wait until it is readable
+	yield <number>						- sleep for that many seconds
+	yield None							- let everything else run first
+	yield <Job>							- wait for a function run in a thread
+										  (see Reactor.thread)
+"""
+
+# Python imports
+import heapq
+import itertools
+import select
+import socket
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+# Other library imports
+from tp.netlib import Connection, failed
+from tp.netlib import objects as tpobjects
+
+# Local imports
+from cache import Cache
+from threads import NetworkThread, MediaThread, nop, socketpair, sendchange, sendorders
+from version import version
+
+class Job(object):
+	"""\
+	A function which is called in a thread of its own (see Reactor.thread).
+
+	A coroutine yields the job to wait for the function to finish and then
+	calls result() to get what it returned (or raise what it raised).
+	"""
+	def __init__(self, function, args, kw):
+		self.function = function
+		self.args     = args
+		self.kw       = kw
+
+		self.value = None
+		self.error = None
+
+	def run(self):
+		try:
+			self.value = self.function(*self.args, **self.kw)
+		except:
+			self.error = sys.exc_info()
+
+	def result(self):
+		if self.error is not None:
+			raise self.error[0], self.error[1], self.error[2]
+		return self.value
+
+class Reactor(object):
+	"""\
+	Runs coroutines until they have all finished.
+	"""
+	def __init__(self):
+		self.ready    = deque()
+		self.readers  = {}
+		self.sleepers = []
+		self.exit     = False
+
+		# Keeps sleepers which wake at the same time in order
+		self.counter  = itertools.count()
+
+		# The number of coroutines waiting for a Job, and those whose Job has
+		# finished (added to by the threads)
+		self.working  = 0
+		self.finished = deque()
+
+		# Used to wake up the select when a Job finishes
+		self.wakeup, self.waker = socketpair()
+		self.wakeup.setblocking(False)
+		self.waker.setblocking(False)
+
+	def spawn(self, coroutine):
+		"""\
+		Starts running a coroutine.
+		"""
+		self.ready.append(coroutine)
+		return coroutine
+
+	def call(self, method, *args, **kw):
+		"""\
+		Calls a method once the currently running coroutine has yielded.
+		"""
+		def wrapper(method=method, args=args, kw=kw):
+			method(*args, **kw)
+			if False:
+				yield None
+		self.spawn(wrapper())
+
+	def thread(self, function, *args, **kw):
+		"""\
+		Returns a Job which calls a function in a thread of its own, for things
+		which can't help blocking (such as connecting or downloading media).
+
+		The thread is started once a coroutine yields the job.
+		"""
+		return Job(function, args, kw)
+
+	def start(self, job, coroutine):
+		"""\
+		Starts a job's thread, the coroutine is run again once it has finished.
+		"""
+		def run(self=self, job=job, coroutine=coroutine):
+			job.run()
+			self.finished.append(coroutine)
+			try:
+				self.waker.send('\0')
+			except socket.error:
+				# Already full of wake ups which haven't been read yet
+				pass
+
+		self.working += 1
+		thread = threading.Thread(target=run)
+		# A server which never answers mustn't stop the program exiting
+		thread.setDaemon(True)
+		thread.start()
+
+	def step(self, coroutine):
+		"""\
+		Runs a coroutine until it next yields.
+		"""
+		try:
+			waiting = coroutine.next()
+		except StopIteration:
+			return
+		except Exception, e:
+			self.error(coroutine, e)
+			return
+
+		if waiting is None:
+			self.ready.append(coroutine)
+		elif isinstance(waiting, (int, long, float)):
+			heapq.heappush(self.sleepers, (time.time()+waiting, self.counter.next(), coroutine))
+		elif isinstance(waiting, Job):
+			self.start(waiting, coroutine)
+		else:
+			self.readers.setdefault(waiting.fileno(), []).append(coroutine)
+
+	def error(self, coroutine, error):
+		"""\
+		Called when a coroutine raises an exception.
+		"""
+		traceback.print_exc()
+
+	def run(self):
+		"""\
+		Runs until there is nothing left to do or stop is called.
+		"""
+		while not self.exit:
+			# Run everything which is ready
+			ready, self.ready = self.ready, deque()
+			for coroutine in ready:
+				self.step(coroutine)
+
+			if self.exit:
+				break
+			elif len(self.ready) > 0:
+				timeout = 0
+			elif len(self.sleepers) > 0:
+				timeout = max(0, self.sleepers[0][0] - time.time())
+			elif len(self.readers) > 0 or self.working > 0:
+				timeout = None
+			else:
+				break
+
+			if len(self.readers) > 0 or self.working > 0:
+				waiting = self.readers.keys()
+				if self.working > 0:
+					waiting.append(self.wakeup.fileno())
+
+				try:
+					readable, ignored, ignored = select.select(waiting, [], [], timeout)
+				except (select.error, socket.error), e:
+					# Something was closed, wake everyone up to find out
+					readable = self.readers.keys()
+
+				for fileno in readable:
+					if fileno in self.readers:
+						self.ready.extend(self.readers.pop(fileno))
+			elif timeout > 0:
+				time.sleep(timeout)
+
+			if self.working > 0:
+				try:
+					while self.wakeup.recv(1024):
+						pass
+				except socket.error:
+					pass
+
+				while len(self.finished) > 0:
+					self.ready.append(self.finished.popleft())
+					self.working -= 1
+
+			now = time.time()
+			while len(self.sleepers) > 0 and self.sleepers[0][0] <= now:
+				self.ready.append(heapq.heappop(self.sleepers)[-1])
+
+	def stop(self):
+		self.exit = True
+
+class Session(object):
+	"""\
+	A connection to a game and its cache which runs on a Reactor.
+
+	This does the job of an Application's NetworkThread (and MediaThread).
+	Events are posted the same way, by calling the On<Event> method of the
+	session for each event.
+
+	Changes posted as CacheDirtyEvents are sent to the server once the cache
+	has been updated (see SendChanges).
+	"""
+	NetworkFailureEvent       = NetworkThread.NetworkFailureEvent
+	NetworkConnectEvent       = NetworkThread.NetworkConnectEvent
+	NetworkTimeRemainingEvent = NetworkThread.NetworkTimeRemainingEvent
+	MediaFailureEvent         = MediaThread.MediaFailureEvent
+	MediaUpdateEvent          = MediaThread.MediaUpdateEvent
+	MediaDownloadDoneEvent    = MediaThread.MediaDownloadDoneEvent
+
+	# Class used to store the media, None for no media
+	MediaClass = None
+	mediaurl = "http://darcs.thousandparsec.net/repos/media/client/"
+
+	def __init__(self, reactor, host, username, password, debug=False, configdir=None, cs="unknown"):
+		self.reactor   = reactor
+		self.host      = host
+		self.username  = username
+		self.password  = password
+		self.debug     = debug
+		self.configdir = configdir
+		self.cs        = cs
+
+		self.connection = Connection()
+		self.cache = None
+		self.media = None
+
+		# Changes waiting to be sent, they are only sent once the cache has
+		# been updated
+		self.dirty   = []
+		self.updated = False
+		self.sender  = None
+
+		# Files waiting to be downloaded
+		self.downloads  = deque()
+		self.downloader = None
+
+	def Post(self, event):
+		"""\
+		Post an event to this session.
+		"""
+		func = 'On' + event.__class__.__name__[:-5]
+		if hasattr(self, func):
+			self.reactor.call(getattr(self, func), event)
+
+	def Start(self, callback=nop):
+		"""\
+		Connects, updates the cache and then waits for async frames.
+		"""
+		return self.reactor.spawn(self.Run(callback))
+
+	def Run(self, callback=nop):
+		try:
+			for waiting in self.ConnectTo(callback):
+				yield waiting
+			if self.cache is None:
+				return
+
+			for waiting in self.CacheUpdate(callback):
+				yield waiting
+
+			self.updated = True
+			self.StartSending()
+
+			for waiting in self.Wait():
+				yield waiting
+		except (IOError, socket.error), e:
+			traceback.print_exc()
+			self.Post(self.NetworkFailureEvent(e))
+
+	def ConnectTo(self, callback=nop):
+		"""\
+		Coroutine which connects and logs in to the server, the cache is set
+		once logged in.
+
+		Each request (and loading the cache) is run in a thread, so the
+		reactor keeps running while waiting for the server.
+		"""
+		callback("Connecting...", mode="connecting")
+		job = self.reactor.thread(self.connection.setup, host=self.host, debug=self.debug)
+		yield job
+		if job.result():
+			self.Post(self.NetworkFailureEvent("Unable to connect to %s." % (self.host,)))
+			return
+
+		job = self.reactor.thread(self.connection.connect, ("libtpclient-py/%s.%s.%s " % version[:3])+self.cs)
+		yield job
+		if failed(job.result()):
+			self.Post(self.NetworkFailureEvent("%s does not appear to be a Thousand Parsec server." % (self.host,)))
+			return
+
+		job = self.reactor.thread(self.connection.features)
+		yield job
+		features = job.result()
+		if failed(features):
+			self.Post(self.NetworkFailureEvent("%s does not appear to be a Thousand Parsec server." % (self.host,)))
+			return
+		self.Post(self.NetworkConnectEvent(features))
+
+		callback("Logging In")
+		job = self.reactor.thread(self.connection.login, self.username, self.password)
+		yield job
+		if failed(job.result()):
+			self.Post(self.NetworkFailureEvent("Unable to login to %s as %s." % (self.host, self.username)))
+			return
+
+		job = self.reactor.thread(Cache, Cache.key(self.host, self.username), self.configdir)
+		yield job
+		self.cache = job.result()
+
+		if not self.MediaClass is None:
+			self.reactor.spawn(self.MediaConnect())
+
+	def CacheUpdate(self, callback=nop):
+		"""\
+		Coroutine which updates the cache.
+		"""
+		try:
+			for waiting in self.cache.iupdate(self.connection, callback):
+				yield waiting
+		finally:
+			# Save what we have, even if the update failed
+			self.cache.save()
+
+	def Wait(self):
+		"""\
+		Coroutine which posts async frames (such as TimeRemaining) as they arrive.
+		"""
+		while True:
+			yield self.connection.s
+
+			# Changes being sent can have read the data already
+			readable, ignored, ignored = select.select([self.connection.s], [], [], 0)
+			if len(readable) > 0:
+				self.connection.pump()
+
+			pending = self.connection.buffered['frames-async']
+			while len(pending) > 0:
+				if not isinstance(pending[0], tpobjects.TimeRemaining):
+					break
+				frame = pending.pop(0)
+				self.Post(self.NetworkTimeRemainingEvent(frame))
+
+	def OnCacheDirty(self, evt):
+		"""\
+		Queues a change to be sent to the server.
+		"""
+		self.dirty.append(evt)
+		self.StartSending()
+
+	def StartSending(self):
+		"""\
+		Starts sending the queued changes, unless they are already being sent
+		or the cache is still being updated.
+		"""
+		if self.updated and self.sender is None and len(self.dirty) > 0:
+			self.sender = self.reactor.spawn(self.SendChanges())
+
+	def SendChanges(self):
+		"""\
+		Coroutine which sends the queued changes to the server.
+
+		The order changes which are queued together are sent as one batch (see
+		threads.sendorders), other changes are sent one at a time.
+		"""
+		try:
+			while len(self.dirty) > 0:
+				if self.dirty[0].what == "orders":
+					events = []
+					while len(self.dirty) > 0 and self.dirty[0].what == "orders":
+						events.append(self.dirty.pop(0))
+					coroutine = sendorders(self.connection, self.cache, events, self.Post)
+				else:
+					coroutine = sendchange(self.connection, self.cache, self.dirty.pop(0), self.Post)
+
+				for waiting in coroutine:
+					yield waiting
+		finally:
+			self.sender = None
+
+	def MediaConnect(self):
+		"""\
+		Coroutine which finds the media available on the server.
+
+		The list of media is downloaded in a thread.
+		"""
+		def connect(self=self):
+			media = self.MediaClass(Cache.key(self.host, self.username), self.mediaurl, self.configdir)
+			media.getfile(media.files)
+			return media
+
+		job = self.reactor.thread(connect)
+		yield job
+		self.media = job.result()
+
+		self.Post(self.MediaUpdateEvent(self.media.getpossible(['png', 'gif'])))
+		self.StartDownloading()
+
+	def GetFile(self, file, timestamp):
+		"""\
+		Queues a file to be downloaded, a MediaDownloadDoneEvent is posted once
+		it has been downloaded.
+		"""
+		self.downloads.append((file, timestamp))
+		self.StartDownloading()
+
+	def StartDownloading(self):
+		"""\
+		Starts downloading the queued files, unless they are already being
+		downloaded or the media isn't ready yet.
+		"""
+		if self.media is not None and self.downloader is None and len(self.downloads) > 0:
+			self.downloader = self.reactor.spawn(self.Download())
+
+	def Download(self):
+		"""\
+		Coroutine which downloads the queued files one at a time, each in a
+		thread.
+		"""
+		try:
+			while len(self.downloads) > 0:
+				file, timestamp = self.downloads.popleft()
+
+				job = self.reactor.thread(self.media.getfile, file, timestamp)
+				yield job
+				try:
+					localfile = job.result()
+				except (IOError, socket.error), e:
+					traceback.print_exc()
+					self.Post(self.MediaFailureEvent(e))
+					continue
+
+				self.Post(self.MediaDownloadDoneEvent(file, localfile=localfile))
+		finally:
+			self.downloader = None
@@ -0,0 +1,326 @@
+"""\
+A spatial index over the positions of the objects in a Cache.
+
+The objects are put in a uniform grid of cubes, so finding what is near a
+position only has to look at the objects in the nearby cells rather than
+every object in the universe. The grid watches the cache's objects so it is
+kept up to date as the cache is updated or changes are applied.
+"""
+
+# Python imports
+import math
+import heapq
+
+# Local imports
+from Log import Watcher
+
+def position(object):
+	"""\
+	Returns the (x, y, z) position of an object (or None if it has none).
+	"""
+	pos = getattr(object, 'pos', None)
+	if pos is None:
+		return None
+	return tuple(pos[:3])
+
+def distance(a, b):
+	return math.sqrt((a[0]-b[0])**2 + (a[1]-b[1])**2 + (a[2]-b[2])**2)
+
+class Grid(Watcher):
+	"""\
+	Finds the objects in the Cache near a position.
+
+	If cellsize is not given, it is picked so there is about one object per
+	cell when the grid is attached. Call rebuild() to pick it again after the
+	universe has changed a lot.
+	"""
+	stores = ("objects",)
+
+	def __init__(self, cache, cellsize=None):
+		self.cache    = cache
+		self.cellsize = cellsize
+
+		self.watchers = {}
+		self.attach()
+
+	def attach(self):
+		"""\
+		Starts watching the cache's objects and adds all of them to the grid.
+
+		Must be called again if the cache creates new dictionaries (for
+		example when it is loaded).
+		"""
+		Watcher.attach(self)
+		self.rebuild(self.cellsize)
+
+	def rebuild(self, cellsize=None):
+		"""\
+		Puts every object into a new grid.
+		"""
+		positions = {}
+		for id, object in self.cache.objects.iteritems():
+			pos = position(object)
+			if not pos is None:
+				positions[id] = pos
+
+		if cellsize is None:
+			cellsize = self.guess(positions.values())
+		self.cellsize = cellsize
+
+		# cell -> {id: position}
+		self.cells     = {}
+		# id -> position
+		self.positions = {}
+		# The lowest and highest cell used on each axis
+		self.low       = [0, 0, 0]
+		self.high      = [-1, -1, -1]
+
+		for id, pos in positions.iteritems():
+			self.add(id, pos)
+
+	def guess(self, positions):
+		"""\
+		Picks a cell size which puts about one object in each cell.
+		"""
+		if len(positions) < 2:
+			return 1.0
+
+		extents = []
+		for axis in range(0, 3):
+			values = [pos[axis] for pos in positions]
+			extent = max(values) - min(values)
+			if extent > 0:
+				extents.append(extent)
+
+		if len(extents) == 0:
+			return 1.0
+
+		volume = 1.0
+		for extent in extents:
+			volume *= extent
+		return max(1.0, (volume / len(positions)) ** (1.0/len(extents)))
+
+	def cell(self, pos):
+		size = self.cellsize
+		return (int(math.floor(pos[0]/size)), int(math.floor(pos[1]/size)), int(math.floor(pos[2]/size)))
+
+	def add(self, id, pos):
+		cell = self.cell(pos)
+		self.cells.setdefault(cell, {})[id] = pos
+		self.positions[id] = pos
+
+		if self.high[0] < self.low[0]:
+			self.low, self.high = list(cell), list(cell)
+			return
+
+		for axis in range(0, 3):
+			if cell[axis] < self.low[axis]:
+				self.low[axis] = cell[axis]
+			elif cell[axis] > self.high[axis]:
+				self.high[axis] = cell[axis]
+
+	def remove(self, id):
+		pos = self.positions.pop(id, None)
+		if pos is None:
+			return
+
+		cell = self.cell(pos)
+		contents = self.cells[cell]
+		del contents[id]
+		if len(contents) == 0:
+			del self.cells[cell]
+
+	def record(self, d, name, key, oldtime, old):
+		pos = position(d.get(key, None))
+		if pos == self.positions.get(key, None):
+			return
+
+		self.remove(key)
+		if not pos is None:
+			self.add(key, pos)
+
+	def __len__(self):
+		return len(self.positions)
+
+	def inbox(self, low, high):
+		"""\
+		Yields the (id, position) of everything in the cells which overlap the
+		box.
+		"""
+		low, high = self.cell(low), self.cell(high)
+
+		number = 1
+		for axis in range(0, 3):
+			number *= high[axis]-low[axis]+1
+
+		if number > len(self.cells):
+			# Quicker to look at every cell
+			for cell, contents in self.cells.iteritems():
+				for axis in range(0, 3):
+					if not low[axis] <= cell[axis] <= high[axis]:
+						break
+				else:
+					for item in contents.iteritems():
+						yield item
+			return
+
+		cells = self.cells
+		for x in xrange(low[0], high[0]+1):
+			for y in xrange(low[1], high[1]+1):
+				for z in xrange(low[2], high[2]+1):
+					if cells.has_key((x, y, z)):
+						for item in cells[(x, y, z)].iteritems():
+							yield item
+
+	def box(self, low, high):
+		"""\
+		Returns the IDs of the objects inside a box given by the (x, y, z) of
+		its lowest and highest corners.
+		"""
+		result = []
+		for id, pos in self.inbox(low, high):
+			for axis in range(0, 3):
+				if not low[axis] <= pos[axis] <= high[axis]:
+					break
+			else:
+				result.append(id)
+		return result
+
+	def within(self, pos, radius):
+		"""\
+		Returns the IDs of the objects no more than radius away from pos.
+		"""
+		low  = (pos[0]-radius, pos[1]-radius, pos[2]-radius)
+		high = (pos[0]+radius, pos[1]+radius, pos[2]+radius)
+
+		radius2 = radius*radius
+		result = []
+		for id, other in self.inbox(low, high):
+			if (pos[0]-other[0])**2 + (pos[1]-other[1])**2 + (pos[2]-other[2])**2 <= radius2:
+				result.append(id)
+		return result
+
+	def ring(self, centre, n):
+		"""\
+		Yields the cells which are n cells away from the centre cell (only
+		those between the lowest and highest cells used).
+		"""
+		ranges = []
+		for axis in range(0, 3):
+			ranges.append(xrange(max(centre[axis]-n, self.low[axis]), min(centre[axis]+n, self.high[axis])+1))
+		xs, ys, zs = ranges
+
+		cx, cy, cz = centre
+		for x in xs:
+			for y in ys:
+				if abs(x-cx) == n or abs(y-cy) == n:
+					for z in zs:
+						yield (x, y, z)
+				else:
+					for z in (cz-n, cz+n):
+						if z in zs:
+							yield (x, y, z)
+
+	def nearest(self, pos, k=1):
+		"""\
+		Returns a list of (distance, id) for the k objects nearest to pos,
+		nearest first.
+		"""
+		if k <= 0 or len(self.positions) == 0:
+			return []
+
+		centre = self.cell(pos)
+
+		# The furthest ring which has any cells
+		last = 0
+		for axis in range(0, 3):
+			last = max(last, centre[axis]-self.low[axis], self.high[axis]-centre[axis])
+
+		# Heap of (-distance, id) of the k nearest found so far
+		found = []
+		looked = 0
+		for n in xrange(0, last+1):
+			for cell in self.ring(centre, n):
+				looked += 1
+				if not self.cells.has_key(cell):
+					continue
+
+				for id, other in self.cells[cell].iteritems():
+					d = distance(pos, other)
+					if len(found) < k:
+						heapq.heappush(found, (-d, id))
+					elif d < -found[0][0]:
+						heapq.heapreplace(found, (-d, id))
+
+			# Anything in a further ring is at least this far away
+			if len(found) == k and -found[0][0] <= n*self.cellsize:
+				break
+
+			if looked > len(self.cells)*4:
+				# Most of the cells are empty, quicker to look at everything
+				return heapq.nsmallest(k, [(distance(pos, other), id) for id, other in self.positions.iteritems()])
+
+		found = [(-d, id) for d, id in found]
+		found.sort()
+		return found
+
+if __name__ == "__main__":
+	# Compare the grid with looking at every object
+	#	python spatial.py
+	import random
+	import time
+
+	from ChangeDict import ChangeDict
+
+	class Object(object):
+		def __init__(self, id, pos):
+			self.id  = id
+			self.pos = pos
+
+	class Universe(object):
+		stores = ("objects",)
+
+		def __init__(self):
+			self.objects = ChangeDict()
+
+	def timeit(function, *args):
+		start = time.time()
+		for i in xrange(100):
+			result = function(*args)
+		return (time.time()-start)/100*1000, result
+
+	for number in (10000, 100000):
+		random.seed(number)
+
+		universe = Universe()
+		for id in xrange(number):
+			universe.objects[id] = (0, Object(id, (random.uniform(-1e9, 1e9), random.uniform(-1e9, 1e9), 0)))
+
+		start = time.time()
+		grid = Grid(universe)
+		built = time.time()-start
+
+		start = time.time()
+		for id in xrange(1000):
+			universe.objects[id] = (1, Object(id, (random.uniform(-1e9, 1e9), random.uniform(-1e9, 1e9), 0)))
+		moved = (time.time()-start)/1000*1000
+
+		pos, radius = (1e8, -2e8, 0), 5e7
+
+		def scanwithin(pos, radius):
+			return [id for id, object in universe.objects.iteritems() if distance(pos, object.pos) <= radius]
+		def scannearest(pos, k):
+			return heapq.nsmallest(k, [(distance(pos, object.pos), id) for id, object in universe.objects.iteritems()])
+
+		gridwithin, a = timeit(grid.within, pos, radius)
+		scanwithin, b = timeit(scanwithin, pos, radius)
+		assert sorted(a) == sorted(b)
+		found = len(a)
+
+		gridnearest, a = timeit(grid.nearest, pos, 10)
+		scannearest, b = timeit(scannearest, pos, 10)
+		assert a == b
+
+		print "%6i objects: built in %.3fs, moving an object %.3fms" % (number, built, moved)
+		print "	within: grid %.3fms scan %.3fms (%i found)" % (gridwithin, scanwithin, found)
+		print "	nearest 10: grid %.3fms scan %.3fms" % (gridnearest, scannearest)
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+"""
+Unit tests on updating, saving and the universe tree of the Cache.
+"""
+
+import time
+import shutil
+import tempfile
+import unittest
+
+from tp.netlib import constants
+import journal
+from cache import Cache
+from ChangeDict import ModTimes
+
+class Thing(object):
+	"""\
+	Stands in for the objects (and players) the server sends.
+	"""
+	def __init__(self, id, modify_time, contains=()):
+		self.id           = id
+		self.modify_time  = modify_time
+		self.contains     = list(contains)
+		self.order_number = 0
+
+class IDs(list):
+	"""\
+	A list of (id, modify time) pairs, newest first, like the ID iterators.
+	"""
+	def __init__(self, things):
+		list.__init__(self, [(thing.id, thing.modify_time) for thing in things])
+		self.sort(lambda a, b: cmp(b[1], a[1]))
+		self.total = len(self)
+
+class Interrupted(Exception):
+	pass
+
+class Connection(object):
+	"""\
+	A server with only objects which can be made to fail part way through
+	getting them.
+	"""
+	def __init__(self, objects):
+		self.objects = objects
+		# The number of get_objects requests before the connection fails
+		self.failafter = None
+
+	def setblocking(self, blocking):
+		pass
+
+	def features(self):
+		return [constants.FEATURE_ORDERED_OBJECT]
+
+	def get_object_ids(self, iter=True):
+		return IDs(self.objects.values())
+
+	def get_objects(self, ids, callback=None):
+		if self.failafter is not None:
+			if self.failafter == 0:
+				raise Interrupted()
+			self.failafter -= 1
+		return [self.objects[id] for id in ids]
+
+	def nothing(self, iter=True):
+		return IDs([])
+	get_board_ids = get_orderdesc_ids = get_category_ids = get_design_ids = nothing
+	get_component_ids = get_property_ids = get_resource_ids = nothing
+
+	def none(self, ids, callback=None):
+		return []
+	get_boards = get_categories = get_designs = get_components = get_properties = get_resources = none
+
+	def get_players(self, id):
+		return [Thing(id, 0)]
+
+def nop(*args, **kw):
+	pass
+
+class UpdateTests(unittest.TestCase):
+	compact = False
+
+	def setUp(self):
+		self.configdir = tempfile.mkdtemp()
+		self.cache = Cache("tp://test@localhost:6923/", configdir=self.configdir, new=True, compact=self.compact)
+		self.cache.chunk = 5
+		self.cache.checkpoints = 1
+
+		self.objects = {0: Thing(0, 10, range(1, 20))}
+		for id in range(1, 20):
+			self.objects[id] = Thing(id, 10+id)
+		self.connection = Connection(self.objects)
+
+	def tearDown(self):
+		self.cache.flush()
+		shutil.rmtree(self.configdir)
+
+	def times(self):
+		return dict([(id, self.cache.objects.times[id]) for id in self.cache.objects.keys()])
+
+	def testUpdate(self):
+		self.cache.update(self.connection, nop)
+		self.assertEquals(self.times(), dict([(id, thing.modify_time) for id, thing in self.objects.items()]))
+		self.assertEquals(self.cache.phase, None)
+
+	def testResume(self):
+		self.cache.update(self.connection, nop)
+
+		# Everything changes on the server, the update is interrupted after
+		# the newest objects have been saved
+		for id, thing in self.objects.items():
+			self.objects[id] = Thing(id, 100+id, thing.contains)
+		self.connection.failafter = 1
+		self.assertRaises(Interrupted, self.cache.update, self.connection, nop)
+		self.assertEquals(self.cache.phase, "objects")
+		self.assertEquals(self.cache.objects.times[19], 119)
+		self.assertEquals(self.cache.objects.times[0], 10)
+
+		# Resuming must still get the older objects
+		self.connection.failafter = None
+		self.cache.update(self.connection, nop)
+		self.assertEquals(self.times(), dict([(id, thing.modify_time) for id, thing in self.objects.items()]))
+		self.assertEquals(self.cache.phase, None)
+
+class CompactUpdateTests(UpdateTests):
+	# The modify times are kept in arrays
+	compact = True
+
+	def testCompact(self):
+		self.cache.update(self.connection, nop)
+		self.failUnless(isinstance(self.cache.objects.times, ModTimes))
+
+class TreeTests(unittest.TestCase):
+	def setUp(self):
+		self.configdir = tempfile.mkdtemp()
+		self.cache = Cache("tp://test@localhost:6923/", configdir=self.configdir, new=True)
+
+		# 0 contains 1 and 2, 1 contains 3 which contains 4
+		for id, contains in ((0, [1, 2]), (1, [3]), (2, []), (3, [4]), (4, [])):
+			self.cache.objects[id] = (1, Thing(id, 1, contains))
+		self.cache.stamp()
+
+	def tearDown(self):
+		self.cache.flush()
+		shutil.rmtree(self.configdir)
+
+	def parents(self):
+		return dict([(id, getattr(object, 'parent', None)) for id, object in self.cache.objects.items()])
+
+	def testTree(self):
+		self.assertEquals(self.parents(), {0: None, 1: 0, 2: 0, 3: 1, 4: 3})
+		self.assertEquals(self.cache.ancestors(4), [3, 1, 0])
+		self.assertEquals(self.cache.ancestors(0), [])
+		self.assertEquals(sorted(self.cache.descendants(1)), [3, 4])
+		self.assertEquals(sorted(self.cache.children(0)), [1, 2])
+		self.assertEquals(sorted([object.id for object in self.cache.subtree(1)]), [1, 3, 4])
+
+	def testMove(self):
+		# 3 (and so 4) moves from 1 to 2
+		self.cache.objects[1] = (2, Thing(1, 2, []))
+		self.cache.objects[2] = (2, Thing(2, 2, [3]))
+		self.cache.stamp()
+
+		self.assertEquals(self.parents(), {0: None, 1: 0, 2: 0, 3: 2, 4: 3})
+		self.assertEquals(self.cache.ancestors(4), [3, 2, 0])
+		self.assertEquals(self.cache.children(1), [])
+		self.assertEquals(self.cache.children(2), [3])
+
+		# Only the object which moved has been changed
+		self.assertEquals(self.cache.objects.times[4], 1)
+
+	def testRemove(self):
+		del self.cache.objects[3]
+		self.cache.objects[1] = (2, Thing(1, 2, []))
+		self.cache.stamp()
+
+		self.assertEquals(self.cache.ancestors(4), [])
+		self.assertEquals(self.cache.descendants(0), [1, 2])
+
+class SaveTests(unittest.TestCase):
+	def setUp(self):
+		self.configdir = tempfile.mkdtemp()
+		self.cache = Cache("tp://test@localhost:6923/", configdir=self.configdir, new=True)
+
+	def tearDown(self):
+		self.cache.flush()
+		shutil.rmtree(self.configdir)
+
+	def kinds(self, cache):
+		cache.flush()
+		return [r[0] for r in cache.journal.load()]
+
+	def testAttributes(self):
+		self.cache.features = [1]
+		self.cache.save()
+		start = len(self.kinds(self.cache))
+
+		# Attributes are only saved again when they change
+		self.cache.save()
+		self.failIf(journal.ATTRIBUTE in self.kinds(self.cache)[start:])
+
+		self.cache.features = [1, 2]
+		self.cache.save()
+		self.failUnless(journal.ATTRIBUTE in self.kinds(self.cache)[start:])
+
+		# Nor after loading them
+		cache = Cache("tp://test@localhost:6923/", configdir=self.configdir)
+		self.assertEquals(cache.features, [1, 2])
+		start = len(self.kinds(cache))
+		cache.save()
+		self.failIf(journal.ATTRIBUTE in self.kinds(cache)[start:])
+		cache.flush()
+
+	def testSaveDoesntWait(self):
+		self.cache.save()
+
+		# Saving doesn't wait for the disk
+		sync = journal.sync
+		def slow(f):
+			time.sleep(0.2)
+			sync(f)
+		journal.sync = slow
+		try:
+			for i in range(0, 3):
+				self.cache.features = [i]
+				start = time.time()
+				self.cache.save()
+				self.failUnless(time.time()-start < 0.1)
+				time.sleep(0.05)
+			self.cache.flush()
+		finally:
+			journal.sync = sync
+
+		cache = Cache("tp://test@localhost:6923/", configdir=self.configdir)
+		self.assertEquals(cache.features, [2])
+		cache.flush()
+
+	def testWriteError(self):
+		self.cache.save()
+		self.cache.flush()
+
+		def fail(records):
+			raise IOError("Disk full")
+		self.cache.journal._append = fail
+		self.cache.features = [1]
+		self.cache.save()
+
+		# The error is raised until a save succeeds
+		self.assertRaises(IOError, self.cache.flush)
+		self.assertRaises(IOError, self.cache.flush)
+
+		# Which is a complete snapshot
+		del self.cache.journal._append
+		self.cache.save()
+		self.cache.flush()
+		cache = Cache("tp://test@localhost:6923/", configdir=self.configdir)
+		self.assertEquals(cache.features, [1])
+		cache.flush()
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+Unit tests on ChangeDict and the ModTimes it keeps the modify times in.
+"""
+
+import random
+import unittest
+
+from ChangeDict import ChangeDict, LazyChangeDict, ModTimes, missing
+
+class ModTimesTests(unittest.TestCase):
+	def fill(self, keys):
+		times = ModTimes()
+		for key in keys:
+			times[key] = float(key)
+		return times
+
+	def check(self, times, keys):
+		self.assertEquals(len(times), len(keys))
+		self.assertEquals(sorted(times.keys()), sorted(keys))
+		for key in keys:
+			self.assertEquals(times[key], float(key))
+
+	def testAscending(self):
+		keys = range(0, 10000)
+		times = self.fill(keys)
+		self.check(times, keys)
+		self.assertEquals(len(times.sparse), 0)
+
+	def testDescending(self):
+		keys = range(9999, -1, -1)
+		times = self.fill(keys)
+		self.check(times, keys)
+		self.assertEquals(len(times.sparse), 0)
+
+	def testRandom(self):
+		keys = range(0, 10000)
+		random.Random(1).shuffle(keys)
+		times = self.fill(keys)
+		self.check(times, keys)
+		self.assertEquals(len(times.sparse), 0)
+
+	def testFarApart(self):
+		# Keys much bigger than the others stay in the dictionary
+		keys = range(0, 1000) + [10**9, -5, "string"]
+		times = ModTimes()
+		for key in keys:
+			times[key] = 1.0
+		self.assertEquals(len(times), len(keys))
+		self.assertEquals(sorted(times.sparse.keys()), sorted([10**9, -5, "string"]))
+
+	def testDelete(self):
+		times = self.fill(range(0, 100))
+		del times[50]
+		self.assertEquals(len(times), 99)
+		self.failIf(times.has_key(50))
+		self.assertEquals(times.get(50, None), None)
+		self.assertRaises(KeyError, times.__getitem__, 50)
+		self.assertRaises(KeyError, times.__delitem__, 50)
+
+		times[50] = 3.0
+		self.assertEquals(times[50], 3.0)
+		self.assertEquals(len(times), 100)
+
+	def testOlder(self):
+		times = self.fill(range(0, 10) + [10**9])
+		pairs = [(1, 1.0), (2, 5.0), (20, 1.0), (10**9, 1.0), (10**9+1, 1.0)]
+		self.assertEquals(times.older(pairs), [2, 20, 10**9+1])
+
+class ChangeDictTests(unittest.TestCase):
+	# The default, a dictionary
+	timesclass = None
+
+	def testTimes(self):
+		d = ChangeDict(self.timesclass)
+		d[1] = (10, "a")
+		self.assertEquals(d.times[1], 10)
+		d[1] = (11, "b")
+		self.assertRaises(ValueError, d.__setitem__, 1, (5, "c"))
+		self.assertEquals((d.times[1], d[1]), (11, "b"))
+
+	def testDirty(self):
+		d = ChangeDict(self.timesclass)
+		d[1] = (10, "a")
+		d.restore(2, 10, "b")
+		self.assertEquals(d.dirty, set([1]))
+		d.clean()
+		del d[2]
+		self.assertEquals(d.dirty, set([2]))
+
+	def testUpdateMany(self):
+		d = ChangeDict(self.timesclass)
+		d[2] = (10, "old")
+		# One entry is too old, so nothing is changed
+		self.assertRaises(ValueError, d.update_many, [(1, 5, "a"), (2, 1, "b")])
+		self.failIf(d.has_key(1))
+
+		d.update_many([(1, 5, "a"), (2, 11, "b")])
+		self.assertEquals((d[1], d[2], d.times[2]), ("a", "b", 11))
+
+	def testStaleIds(self):
+		d = ChangeDict(self.timesclass)
+		d[1] = (10, "a")
+		d[2] = (10, "b")
+		self.assertEquals(d.stale_ids([(1, 10), (2, 11), (3, 1)]), [2, 3])
+
+	def testWatchers(self):
+		changes = []
+		d = ChangeDict(self.timesclass)
+		d.watchers.append(lambda d, key, oldtime, old: changes.append((key, oldtime, old, d.get(key, missing))))
+		d[1] = (10, "a")
+		d[1] = (11, "b")
+		del d[1]
+		self.assertEquals(changes, [(1, None, missing, "a"), (1, 10, "a", "b"), (1, 11, "b", missing)])
+
+	def testLazy(self):
+		decoded = []
+		def decode(key, value):
+			decoded.append(key)
+			return value.upper()
+
+		d = LazyChangeDict(decode, self.timesclass)
+		d.defer(1, 10, "a")
+		d.defer(2, 10, "b")
+		self.assertEquals(decoded, [])
+		self.assertEquals(d[1], "A")
+		self.assertEquals(decoded, [1])
+
+		# Replacing a value which was never decoded doesn't decode it
+		d[2] = (11, "c")
+		self.assertEquals(decoded, [1])
+		self.assertEquals(d.items(), [(1, "A"), (2, "c")])
+
+class CompactChangeDictTests(ChangeDictTests):
+	timesclass = ModTimes
+
+	def testTimesClass(self):
+		self.failUnless(isinstance(ChangeDict().times, dict))
+		self.failUnless(isinstance(ChangeDict(ModTimes).times, ModTimes))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+Unit tests on the Log (undo and redo) and History of a Cache.
+"""
+
+import unittest
+
+from ChangeDict import ChangeDict, missing
+from Log import Log, History
+
+class Cache(object):
+	"""\
+	Stands in for the Cache, only the dictionaries are needed.
+	"""
+	stores = ("objects", "orders")
+
+	def __init__(self):
+		self.objects = ChangeDict()
+		self.orders  = ChangeDict()
+
+class LogTests(unittest.TestCase):
+	def setUp(self):
+		self.cache = Cache()
+		self.cache.objects[1] = (1, "one")
+		self.log = Log(self.cache)
+
+	def testUndoRedo(self):
+		self.log.begin("move")
+		self.cache.objects[1] = (2, "moved")
+		self.cache.objects[2] = (2, "new")
+		self.log.end()
+
+		batch = self.log.undo()
+		self.assertEquals(batch.label, "move")
+		self.assertEquals(self.cache.objects.items(), [(1, "one")])
+		self.assertEquals(self.cache.objects.times[1], 1)
+		self.assertEquals(self.log.undo(), None)
+
+		self.log.redo()
+		self.assertEquals(self.cache.objects[1], "moved")
+		self.assertEquals(self.cache.objects[2], "new")
+		self.assertEquals(self.log.redo(), None)
+
+	def testChangeForgetsRedo(self):
+		self.cache.objects[1] = (2, "two")
+		self.log.undo()
+		self.cache.objects[1] = (3, "three")
+		self.assertEquals(self.log.redo(), None)
+		self.assertEquals(self.cache.objects[1], "three")
+
+	def testDepth(self):
+		self.log.depth = 2
+		for i in range(5):
+			self.log.begin(i)
+			self.cache.objects[1] = (2+i, i)
+		self.log.end()
+		self.assertEquals([batch.label for batch in self.log.batches()], [4, 3])
+
+	def testSize(self):
+		self.log.size = 10
+		self.log.begin("small")
+		self.cache.objects[1] = (2, "two")
+		self.log.end()
+
+		# A batch which is too big can't be undone, nor can the ones before
+		for i in range(20):
+			self.cache.orders[i] = (1, i)
+		self.assertEquals(self.log.batches(), [])
+		self.assertEquals(self.log.undo(), None)
+		self.assertEquals(len(self.cache.orders), 20)
+
+		# Smaller batches are kept until there are size changes
+		for i in range(4):
+			self.log.begin(i)
+			self.cache.objects[1] = (3+i, i)
+			self.cache.objects[2] = (3+i, i)
+			self.cache.objects[3] = (3+i, i)
+		self.log.end()
+		self.assertEquals([batch.label for batch in self.log.batches()], [3, 2, 1])
+		self.assertEquals(self.log.count, 9)
+
+	def testView(self):
+		self.log.begin("first")
+		self.cache.objects[1] = (2, "two")
+		self.log.begin("second")
+		self.cache.objects[1] = (3, "three")
+		del self.cache.objects[1]
+		self.cache.objects[2] = (3, "new")
+		self.log.end()
+
+		view = self.log.view("second")
+		self.assertEquals(view.objects[1], "two")
+		self.assertEquals(view.objects.time(1), 2)
+		self.failIf(view.objects.has_key(2))
+
+		view = self.log.view("first")
+		self.assertEquals(view.objects.items(), [(1, "one")])
+		self.assertRaises(KeyError, self.log.view, "third")
+
+class HistoryTests(unittest.TestCase):
+	def setUp(self):
+		self.cache = Cache()
+		self.cache.objects[1] = (1, "one")
+		self.history = History(self.cache)
+		self.history.mark(1)
+
+	def testVersions(self):
+		self.cache.objects[1] = (2, "two")
+		self.cache.objects[2] = (2, "new")
+		self.history.mark(2)
+		del self.cache.objects[1]
+		self.history.mark(4)
+
+		self.assertEquals(self.history.get("objects", 1, 1), "one")
+		self.assertEquals(self.history.get("objects", 1, 3), "two")
+		self.assertEquals(self.history.get("objects", 1, 4), None)
+		self.assertEquals(self.history.get("objects", 2, 1), None)
+		self.assertEquals(self.history.version("objects", 2, 2), (2, "new"))
+		self.assertRaises(KeyError, self.history.version, "objects", 1, 0)
+
+	def testMarkOrder(self):
+		self.assertRaises(ValueError, self.history.mark, 1)
+
+	def testDiff(self):
+		self.cache.objects[1] = (2, "two")
+		self.history.mark(2)
+		self.cache.objects[2] = (3, "new")
+		self.history.mark(3)
+
+		self.assertEquals(self.history.diff("objects", 1, 3), {1: ("one", "two"), 2: (missing, "new")})
+		self.assertEquals(self.history.diff("objects", 2, 3), {2: (missing, "new")})
+		self.assertEquals(self.history.diff("orders", 1, 3), {})
+		self.assertRaises(ValueError, self.history.diff, "objects", 3, 1)
+
+	def testChangedBack(self):
+		value = self.cache.objects[1]
+		self.cache.objects[1] = (2, "two")
+		self.cache.objects[1] = (3, value)
+		self.history.mark(2)
+		self.assertEquals(self.history.changed[2], set())
+
+if __name__ == '__main__':
+	unittest.main()
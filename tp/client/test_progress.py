@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+Unit tests on the progress reports of an update.
+"""
+
+import unittest
+
+import progress
+from progress import Reporter, Messages, Throttled, reporter
+
+class Recorder(object):
+	"""\
+	An update callback which remembers what it was called with.
+	"""
+	def __init__(self):
+		self.calls = []
+
+	def __call__(self, message, **kw):
+		self.calls.append((message, kw))
+
+class ReporterTests(unittest.TestCase):
+	def testCounts(self):
+		steps = []
+		report = Reporter(steps.append)
+		report(progress.START, "objects", group="objects")
+		report(progress.TOTAL, "objects", total=3)
+		report(progress.GOT, "objects", 1, 10)
+		report(progress.FAILED, "objects")
+		report(progress.SKIPPED, "objects", 3, 10)
+		report(progress.FINISHED, "objects")
+
+		self.assertEquals([(step.kind, step.done, step.total) for step in steps], [
+			(progress.START, 0, None),
+			(progress.TOTAL, 0, 3),
+			(progress.GOT, 1, 3),
+			(progress.FAILED, 2, 3),
+			(progress.SKIPPED, 3, 3),
+			(progress.FINISHED, 3, 3),
+		])
+		self.assertEquals(steps[0].group, "objects")
+		self.assertEquals((steps[2].id, steps[2].time), (1, 10))
+
+	def testReporter(self):
+		report = Reporter([].append)
+		self.failUnless(reporter(report) is report)
+
+		messages = Messages(Recorder())
+		self.failUnless(reporter(messages).sink is messages)
+		self.failUnless(isinstance(reporter(Recorder()).sink, Messages))
+
+class MessagesTests(unittest.TestCase):
+	def testMessages(self):
+		callback = Recorder()
+		report = reporter(callback)
+		report(progress.START, "features", group="connecting")
+		report(progress.START, "boards", group="boards")
+		report(progress.TOTAL, "boards", total=2)
+		report(progress.GOT, "boards", 7, 0)
+
+		self.assertEquals(callback.calls[:3], [
+			("Looking for supported features...", {'mode': "connecting"}),
+			("Getting boards...", {'mode': "boards"}),
+			("Have 2 boards to get...", {'of': 2}),
+		])
+		message, kw = callback.calls[3]
+		self.failUnless(message.startswith("Got board with ID of 7 "))
+		self.assertEquals(kw, {'add': 1})
+
+class ThrottledTests(unittest.TestCase):
+	def testThrottled(self):
+		callback = Recorder()
+		report = reporter(Throttled(callback, interval=3600))
+		report(progress.START, "objects", group="objects")
+		for id in range(10):
+			report(progress.GOT, "objects", id, 0)
+		report(progress.FINISHED, "objects")
+
+		# Only the first and the last of the objects got are passed on
+		self.assertEquals(len(callback.calls), 4)
+		self.assertEquals([kw for message, kw in callback.calls], [
+			{'mode': "objects"},
+			{'add': 1},
+			{'add': 9},
+			{},
+		])
+		self.failUnless(callback.calls[2][0].startswith("Got object with ID of 9 "))
+
+		# The messages are plain strings
+		for message, kw in callback.calls:
+			self.failUnless(type(message) is str)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+Unit tests on the Grid spatial index.
+"""
+
+import random
+import unittest
+
+from ChangeDict import ChangeDict
+from spatial import Grid, distance
+
+class Object(object):
+	def __init__(self, id, pos):
+		self.id  = id
+		self.pos = pos
+
+class Cache(object):
+	"""\
+	Stands in for the Cache, only the objects are needed.
+	"""
+	stores = ("objects",)
+
+	def __init__(self):
+		self.objects = ChangeDict()
+
+class GridTests(unittest.TestCase):
+	def setUp(self):
+		self.random = random.Random(1)
+		self.cache = Cache()
+		for id in range(0, 500):
+			self.cache.objects[id] = (0, Object(id, self.position()))
+		self.grid = Grid(self.cache)
+
+	def position(self):
+		return (self.random.uniform(-1000, 1000), self.random.uniform(-1000, 1000), self.random.uniform(-10, 10))
+
+	def within(self, pos, radius):
+		return sorted([id for id, object in self.cache.objects.iteritems() if distance(pos, object.pos) <= radius])
+
+	def nearest(self, pos, k):
+		found = [(distance(pos, object.pos), id) for id, object in self.cache.objects.iteritems()]
+		found.sort()
+		return found[:k]
+
+	def check(self):
+		for i in range(0, 20):
+			pos = self.position()
+			self.assertEquals(sorted(self.grid.within(pos, 150)), self.within(pos, 150))
+			self.assertEquals(self.grid.nearest(pos, 5), self.nearest(pos, 5))
+
+	def testQueries(self):
+		self.assertEquals(len(self.grid), 500)
+		self.check()
+
+	def testBox(self):
+		low, high = (-100, -200, -10), (300, 100, 10)
+		expected = []
+		for id, object in self.cache.objects.iteritems():
+			if -100 <= object.pos[0] <= 300 and -200 <= object.pos[1] <= 100:
+				expected.append(id)
+		self.assertEquals(sorted(self.grid.box(low, high)), sorted(expected))
+
+	def testChanges(self):
+		# Moved, removed and new objects are followed
+		for id in range(0, 100):
+			self.cache.objects[id] = (1, Object(id, self.position()))
+		for id in range(100, 150):
+			del self.cache.objects[id]
+		for id in range(500, 550):
+			self.cache.objects[id] = (1, Object(id, self.position()))
+		self.assertEquals(len(self.grid), 500)
+		self.check()
+
+	def testFarAway(self):
+		# An object far outside the others extends the grid
+		self.cache.objects[1000] = (1, Object(1000, (1e6, 1e6, 0)))
+		self.assertEquals(self.grid.nearest((1e6, 1e6, 1), 1), [(1.0, 1000)])
+		self.assertEquals(self.grid.within((1e6, 1e6, 0), 1), [1000])
+		self.check()
+
+	def testNoPosition(self):
+		self.cache.objects[1] = (1, Object(1, None))
+		self.failIf(1 in self.grid.within(self.cache.objects[2].pos, 5000))
+		self.assertEquals(len(self.grid), 499)
+
+	def testNearestMoreThanThere(self):
+		self.assertEquals(len(self.grid.nearest((0, 0, 0), 1000)), 500)
+		self.assertEquals(self.grid.nearest((0, 0, 0), 0), [])
+
+		cache = Cache()
+		self.assertEquals(Grid(cache).nearest((0, 0, 0), 1), [])
+
+if __name__ == '__main__':
+	unittest.main()
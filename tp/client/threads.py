@@ -1,5 +1,8 @@
 
+import errno
 import pprint
+import Queue
+import select
 import socket
 import sys
 import time
@@ -9,6 +12,7 @@ import traceback
 
 from cache import Cache
 from media import Media
+from pipeline import Pipeline
 
 from config import load_data, save_data
 from version import version
@@ -22,8 +26,14 @@ class Application(object):
 
 	Calling accross threads requires you to use the .Call method on each thread - DO NOT call directly!
 	The cache can be accessed by either thread at any time - be careful.
+
+	If optimistic is True changes to the cache are applied (and the
+	CacheUpdateEvent posted) straight away, without waiting for the server.
+	Changes the server rejects are undone and a CacheRollbackEvent posted.
 	"""
-	
+	optimistic = False
+
+
 	def __init__(self):
 		print self.GUIClass, self.NetworkClass, self.MediaClass
 		self.gui = self.GUIClass(self)
@@ -75,6 +85,9 @@ class Application(object):
 		"""\
 		Post an application wide event to every thread.
 		"""
+		if self.optimistic and isinstance(event, Cache.CacheDirtyEvent) and not self.cache is None:
+			self.gui.Call(self.gui.Post, self.cache.optimistic(event))
+
 		self.network.Call(self.network.Post, event)
 		self.media.Call(self.media.Post, event)
 		self.gui.Call(self.gui.Post, event)
@@ -92,46 +105,330 @@ class Application(object):
 		self.gui.Cleanup()
 
 class CallThread(threading.Thread):
+	"""\
+	A thread which runs methods given to it with Call.
+
+	The thread sleeps until a call arrives, unless timeout() says every() or
+	idle() need to be run sooner.
+	"""
 	def __init__(self):
 		threading.Thread.__init__(self)
 		self.exit = False
-		self.tocall = []
+		self.tocall = Queue.Queue()
 	
 	def run(self):
 		while not self.exit:
 			self.every()
 
-			if len(self.tocall) <= 0:
+			try:
+				method, args, kw = self.wait(self.timeout())
+			except Queue.Empty:
 				self.idle()
 				continue
 
-			method, args, kw = self.tocall.pop(0)
+			# Woken up by Cleanup
+			if method is None:
+				continue
+
 			try:
 				method(*args, **kw)
 			except Exception, e:
 				self.error(e)
 
+	def timeout(self):
+		"""\
+		Returns how long to wait for a call before running idle(), None waits
+		until a call arrives.
+		"""
+		return None
+
+	def wait(self, timeout):
+		"""\
+		Waits for the next call, raises Queue.Empty if the timeout expires.
+		"""
+		return self.tocall.get(True, timeout)
+
 	def every(self):
 		pass
 
 	def idle(self):
-		time.sleep(0.1)
+		pass
 
 	def error(self, error):
 		pass
 
 	def Cleanup(self):
-		del self.tocall[:]
+		try:
+			while True:
+				self.tocall.get_nowait()
+		except Queue.Empty:
+			pass
 		self.exit = True
+		self.tocall.put((None, (), {}))
 
 	def Call(self, method, *args, **kw):
 		"""\
 		Call a method in this thread.
 		"""
-		self.tocall.append((method, args, kw))
+		self.tocall.put((method, args, kw))
 
 from tp.netlib import Connection, failed
 from tp.netlib import objects as tpobjects
+
+def socketpair():
+	"""\
+	Returns a pair of connected sockets.
+	"""
+	if hasattr(socket, 'socketpair'):
+		return socket.socketpair()
+
+	# Windows doesn't have socketpair
+	listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	listener.bind(('127.0.0.1', 0))
+	listener.listen(1)
+	a = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	a.connect(listener.getsockname())
+	b, address = listener.accept()
+	listener.close()
+	return a, b
+
+def finish(coroutine):
+	"""\
+	Runs a coroutine which yields pipelines (such as sendorders) until it is
+	done, blocking while each pipeline waits for the server.
+
+	An error while waiting is raised inside the coroutine, so it can handle it
+	like an error from the pipeline itself.
+	"""
+	try:
+		pipeline = coroutine.next()
+		while True:
+			try:
+				pipeline.wait()
+			except Exception:
+				pipeline = coroutine.throw(*sys.exc_info())
+			else:
+				pipeline = coroutine.next()
+	except StopIteration:
+		pass
+
+def sendchange(connection, cache, evt, post):
+	"""\
+	Coroutine which sends a change (other than to the orders) to the server.
+
+	The pipeline is yielded while waiting for the server. The change is then
+	applied to the cache and the event posted with post (or rolled back if the
+	server didn't accept it).
+	"""
+	try:
+		# FIXME: Assuming that these should succeed is BAD!
+		if evt.what == "messages" and evt.action == "remove":
+			method, args, message = connection.remove_messages, (evt.id, evt.slot), "Unable to remove the message..."
+		elif evt.what == "designs":
+			method, args, message = {
+				"remove": (connection.remove_designs, (evt.change,), "Unable to remove the design..."),
+				"change": (connection.change_design,  (evt.change,), "Unable to change the design..."),
+				"create": (connection.insert_design,  (evt.change,), "Unable to add the design..."),
+			}[evt.action]
+		elif evt.what == "categories":
+			method, args, message = {
+				"remove": (connection.remove_categories, (evt.change,), "Unable to remove the category..."),
+				"change": (connection.change_category,   (evt.change,), "Unable to change the category..."),
+				"create": (connection.insert_category,   (evt.change,), "Unable to add the category..."),
+			}[evt.action]
+		else:
+			raise ValueError("Can't deal with that yet!")
+
+		results = []
+		pipeline = Pipeline(connection)
+		pipeline.submit(results.append, method, *args)
+		for waiting in pipeline.run():
+			yield waiting
+
+		result = results[0]
+		if failed(result):
+			raise IOError(message)
+
+		if evt.action == "create":
+			# Need to update the event with the new ID of the design.
+			evt.id = result.id
+
+		if getattr(evt, 'pending', False):
+			cache.confirm(evt)
+		else:
+			cache.apply(evt)
+		cache.save()
+		post(evt)
+
+	except Exception, e:
+		type, val, tb = sys.exc_info()
+		sys.stderr.write("".join(traceback.format_exception(type, val, tb)))
+		post(NetworkThread.NetworkFailureEvent(e))
+
+		# Undo the change which was made before we got here
+		if getattr(evt, 'pending', False):
+			cache.rollback(evt, e)
+			post(evt)
+		"There where the following errors when trying to send changes to the server:"
+		"The following updates could not be made:"
+
+def sendorders(connection, cache, events, post):
+	"""\
+	Coroutine which sends a batch of order changes to the server.
+
+	The remove, insert and get requests for every change are pipelined, so
+	a batch of changes costs a few round trips rather than three for each
+	change. The pipeline is yielded while waiting for the server. The changes
+	are then applied to the cache together and the events posted with post.
+	"""
+	pipeline = Pipeline(connection)
+
+	errors = {}
+	def check(result, i, message):
+		if failed(result) and not errors.has_key(i):
+			errors[i] = IOError(message)
+
+	def got(result, i, evt):
+		# The order itself can be a failure inside the list
+		if not failed(result):
+			result = result[0]
+
+		if failed(result):
+			check(result, i, "Unable to get the order...")
+		else:
+			evt.change = result
+
+	# The number of orders on each object after the changes before it
+	counts = {}
+	for i, evt in enumerate(events):
+		if not counts.has_key(evt.id):
+			counts[evt.id] = len(cache.orders[evt.id])
+
+		if evt.action in ("remove", "change"):
+			pipeline.submit(lambda result, i=i: check(result, i, "Unable to remove the order..."),
+				connection.remove_orders, evt.id, evt.slot)
+
+			if evt.action == "remove":
+				if isinstance(evt.slot, (list, tuple)):
+					counts[evt.id] -= len(evt.slot)
+				else:
+					counts[evt.id] -= 1
+
+		if evt.action in ("create", "change"):
+			# FIXME: Maybe an insert_order should return the order object not okay/fail
+			pipeline.submit(lambda result, i=i: check(result, i, "Unable to insert the order..."),
+				connection.insert_order, evt.id, evt.slot, evt.change)
+
+			if evt.slot == -1:
+				evt.slot = counts[evt.id]
+			if evt.action == "create":
+				counts[evt.id] += 1
+
+			pipeline.submit(lambda result, i=i, evt=evt: got(result, i, evt),
+				connection.get_orders, evt.id, evt.slot)
+
+	failure = None
+	try:
+		for waiting in pipeline.run():
+			yield waiting
+	except Exception, e:
+		traceback.print_exc()
+		post(NetworkThread.NetworkFailureEvent(e))
+		failure = e
+		for i in range(0, len(events)):
+			errors[i] = e
+
+	# Objects where something went wrong no longer match the server
+	resync = {}
+	posted = []
+	for i, evt in enumerate(events):
+		if errors.has_key(i):
+			# The connection failing has already been posted
+			if errors[i] is not failure:
+				post(NetworkThread.NetworkFailureEvent(errors[i]))
+			if not resync.has_key(evt.id):
+				resync[evt.id] = errors[i]
+		elif not resync.has_key(evt.id):
+			if getattr(evt, 'pending', False):
+				cache.confirm(evt)
+			else:
+				cache.apply(evt)
+			posted.append(evt)
+
+	resynced = {}
+	if len(resync) > 0:
+		for waiting in resyncorders(connection, cache, resync.keys(), resynced):
+			yield waiting
+
+	for id, error in resync.items():
+		# Changes which were applied before the server accepted them
+		pending = []
+		for evt in events:
+			if evt.id == id and getattr(evt, 'pending', False) and evt.__class__ is Cache.CacheDirtyEvent:
+				pending.append(evt)
+
+		if resynced[id]:
+			for evt in pending:
+				cache.settle(evt)
+		elif len(pending) > 0:
+			# Fall back to putting back what we had
+			cache.rollback(pending[0], error)
+			for evt in pending[1:]:
+				cache.settle(evt)
+
+		if len(pending) > 0:
+			posted.append(Cache.CacheRollbackEvent("orders", id, error))
+		else:
+			posted.append(Cache.CacheUpdateEvent(None))
+
+	cache.save()
+	for evt in posted:
+		post(evt)
+
+def resyncorders(connection, cache, ids, resynced):
+	"""\
+	Coroutine which gets objects and their orders from the server again.
+
+	resynced[id] is set to whether each object (and all its orders) was got.
+	"""
+	pipeline = Pipeline(connection)
+
+	def gotorders(orders, id, object):
+		if failed(orders):
+			return
+		for order in orders:
+			if failed(order):
+				return
+
+		cache.objects[id] = (object.modify_time, object)
+		cache.orders[id]  = (object.modify_time, orders)
+		resynced[id] = True
+
+	def gotobject(result, id):
+		if failed(result) or failed(result[0]):
+			return
+
+		object = result[0]
+		if object.order_number > 0:
+			pipeline.submit(lambda orders, id=id, object=object: gotorders(orders, id, object),
+				connection.get_orders, id, range(0, object.order_number))
+		else:
+			gotorders([], id, object)
+
+	for id in ids:
+		resynced[id] = False
+		pipeline.submit(lambda result, id=id: gotobject(result, id),
+			connection.get_objects, id=id)
+
+	try:
+		for waiting in pipeline.run():
+			yield waiting
+	except (IOError, socket.error, select.error):
+		traceback.print_exc()
+
+	# The objects from the server don't know their parents
+	cache.stamp()
+
 class NetworkThread(CallThread):
 	## These are network events
 	class NetworkFailureEvent(Exception):
@@ -179,13 +476,101 @@ class NetworkThread(CallThread):
 		self.application = application
 		self.connection = Connection()
 
+		# Used to wake up the select in wait() when a call is made
+		self.wakeup, self.waker = socketpair()
+		self.wakeup.setblocking(False)
+		self.waker.setblocking(False)
+
+		# The socket of the connection once select has found it closed
+		self.closed = None
+
+		# Has data arrived on the connection?
+		self.readable = False
+
+		# Order changes waiting to be sent to the server
+		self.dirty = []
+
+	def run(self):
+		CallThread.run(self)
+
+		# Make sure the cache has been written before the thread exits
+		if self.application.cache is not None:
+			try:
+				self.application.cache.flush()
+			except Exception:
+				traceback.print_exc()
+
+	def Call(self, method, *args, **kw):
+		"""\
+		Call a method in this thread.
+		"""
+		CallThread.Call(self, method, *args, **kw)
+		self.wake()
+
+	def Cleanup(self):
+		CallThread.Cleanup(self)
+		self.wake()
+
+	def wake(self):
+		"""\
+		Wakes up the select in wait().
+		"""
+		try:
+			self.waker.send('\0')
+		except socket.error, e:
+			# Already full of wake ups which haven't been read yet
+			if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+				raise
+
+	def wait(self, timeout):
+		"""\
+		Waits for either a call to be made or data to arrive on the connection.
+		"""
+		try:
+			return self.tocall.get_nowait()
+		except Queue.Empty:
+			pass
+
+		waiting = [self.wakeup]
+		connection = getattr(self.connection, 's', None)
+		if connection is not None and connection is not self.closed:
+			waiting.append(connection)
+
+		try:
+			ready, ignored, ignored = select.select(waiting, [], [], timeout)
+		except (select.error, socket.error), e:
+			if e.args[0] == errno.EINTR:
+				# Interrupted by a signal, try again
+				ready = []
+			elif e.args[0] in (errno.EBADF, getattr(errno, 'WSAENOTSOCK', errno.EBADF)) and connection in waiting:
+				# The connection was closed, stop waiting on it
+				self.closed = connection
+				ready = []
+			else:
+				raise
+
+		if self.wakeup in ready:
+			try:
+				while self.wakeup.recv(1024):
+					pass
+			except socket.error:
+				pass
+
+		if connection in ready:
+			self.readable = True
+
+		return self.tocall.get_nowait()
+
 	def every(self):
 		"""\
 		Check's if there are any async frames pending. If so creates the correct
 		events and posts them.
 		"""
 		try:
-			self.connection.pump()
+			# Only read from the connection when something has arrived
+			if self.readable:
+				self.readable = False
+				self.connection.pump()
 
 			pending = self.connection.buffered['frames-async']
 			while len(pending) > 0:
@@ -272,6 +657,13 @@ class NetworkThread(CallThread):
 			self.application.Post(self.NetworkFailureEvent(s))
 			return False
 
+		# The last cache must be written before it can be opened again
+		if self.application.cache is not None:
+			try:
+				self.application.cache.flush()
+			except Exception:
+				traceback.print_exc()
+
 		# Create a new cache
 		self.application.cache = Cache(Cache.key(host, username))
 		return True
@@ -280,78 +672,41 @@ class NetworkThread(CallThread):
 		try:
 			self.application.cache.update(self.connection, callback)
 			self.application.cache.save()
+			self.application.cache.flush()
 		except Exception, e:
 			traceback.print_exc()
+
+			# Save what we have so the next update can carry on from here
+			try:
+				self.application.cache.save()
+				self.application.cache.flush()
+			except Exception:
+				traceback.print_exc()
+
 			self.application.Post(self.NetworkFailureEvent(e))	
 			raise
 
 	def OnCacheDirty(self, evt):
 		"""\
 		When the cache gets dirty we have to push the changes to the server.
+
+		Order changes are queued up and sent together by SendOrders once the
+		calls which are already waiting have been run.
 		"""
-		try:
-			if evt.what == "orders":
-				if evt.action in ("remove", "change"):
-					if failed(self.connection.remove_orders(evt.id, evt.slot)):
-						raise IOError("Unable to remove the order...")
-				
-				if evt.action in ("create", "change"):
-					# FIXME: Maybe an insert_order should return the order object not okay/fail
-					if failed(self.connection.insert_order(evt.id, evt.slot, evt.change)):
-						raise IOError("Unable to insert the order...")
-
-					if evt.slot == -1:
-						evt.slot = len(self.application.cache.orders[evt.id])
-						
-					o = self.connection.get_orders(evt.id, evt.slot)[0]
-					if failed(o):
-						raise IOError("Unable to get the order..." + o[1])
-
-					evt.change = o
-			elif evt.what == "messages" and evt.action == "remove":
-				if failed(self.connection.remove_messages(evt.id, evt.slot)):
-					raise IOError("Unable to remove the message...")
-			elif evt.what == "designs":
-				# FIXME: Assuming that these should succeed is BAD!
-				if evt.action == "remove":
-					if failed(self.connection.remove_designs(evt.change)):
-						raise IOError("Unable to remove the design...")
-				if evt.action == "change":
-					if failed(self.connection.change_design(evt.change)):
-						raise IOError("Unable to change the design...")
-				if evt.action == "create":
-					result = self.connection.insert_design(evt.change)
-					if failed(result):
-						raise IOError("Unable to add the design...")
-					
-					# Need to update the event with the new ID of the design.
-					evt.id = result.id
-			elif evt.what == "categories":
-				# FIXME: Assuming that these should succeed is BAD!
-				if evt.action == "remove":
-					if failed(self.connection.remove_categories(evt.change)):
-						raise IOError("Unable to remove the category...")
-				if evt.action == "change":
-					if failed(self.connection.change_category(evt.change)):
-						raise IOError("Unable to change the category...")
-				if evt.action == "create":
-					result = self.connection.insert_category(evt.change)
-					if failed(result):
-						raise IOError("Unable to add the category...")
-					
-					# Need to update the event with the new ID of the design.
-					evt.id = result.id
-			else:
-				raise ValueError("Can't deal with that yet!")
-			self.application.cache.apply(evt)
-			self.application.Post(evt)
+		if evt.what == "orders":
+			if len(self.dirty) == 0:
+				self.Call(self.SendOrders)
+			self.dirty.append(evt)
+			return
 
-		except Exception, e:
-			type, val, tb = sys.exc_info()
-			sys.stderr.write("".join(traceback.format_exception(type, val, tb)))
-			self.application.Post(self.NetworkFailureEvent(e))
-			"There where the following errors when trying to send changes to the server:"
-			"The following updates could not be made:"
+		finish(sendchange(self.connection, self.application.cache, evt, self.application.Post))
+
+	def SendOrders(self):
+		"""\
+		Sends all the queued order changes to the server (see sendorders).
+		"""
+		events, self.dirty = self.dirty, []
+		finish(sendorders(self.connection, self.application.cache, events, self.application.Post))
 
 
 class MediaThread(CallThread):
@@ -409,9 +764,14 @@ class MediaThread(CallThread):
 		self.todownload = {}
 		self.tostop = []
 	
+	def timeout(self):
+		# Don't wait if there is something to download
+		if len(self.todownload) > 0:
+			return 0
+		return None
+
 	def idle(self):
 		if len(self.todownload) <= 0:
-			CallThread.idle(self)
 			return
 
 		file, timestamp = self.todownload.iteritems().next()
@@ -484,3 +844,25 @@ class MediaThread(CallThread):
 		self.cache.getfile(self.cache.files)
 		files = getpossible_wrapper()
 		self.application.Post(self.MediaUpdateEvent(files))
+
+if __name__ == "__main__":
+	# Measure the round trip time of a Call to another thread
+	samples = 1000
+
+	thread = CallThread()
+	thread.setDaemon(True)
+	thread.start()
+
+	done = threading.Event()
+	times = []
+	for i in range(0, samples):
+		done.clear()
+		start = time.time()
+		thread.Call(done.set)
+		done.wait()
+		times.append(time.time()-start)
+	thread.Cleanup()
+
+	times.sort()
+	print "Call() round trip over %i calls: min %.3fms median %.3fms max %.3fms" % (samples,
+		times[0]*1000, times[len(times)/2]*1000, times[-1]*1000)